@@ -0,0 +1,71 @@
+'''Compares building audit updates by deep copying the document with ModelView._audit_updates, on documents
+with big embedded lists.
+
+    python benchmarks/audit_diff.py [list_length] [iterations]'''
+import django, os, sys, timeit
+from copy import deepcopy
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from django.conf import settings
+settings.configure(INSTALLED_APPS=['django.contrib.auth', 'django.contrib.contenttypes'])
+django.setup()
+
+from bson import ObjectId, SON
+from django_mongo_rest import audit
+from django_mongo_rest.model_view import ModelView
+
+ALLOWED_FIELDS = {'title': 1, 'rows': ('name', 'amount'), 'owner': {'name': 1}}
+
+def make_doc(list_length):
+    return SON([
+        ('_id', ObjectId()),
+        ('title', 'document'),
+        ('owner', SON([('_id', ObjectId()), ('name', 'owner')])),
+        ('rows', [SON([('_id', ObjectId()), ('name', 'row %d' % i), ('amount', i), ('tags', ['a', 'b', 'c'])])
+                  for i in range(list_length)]),
+    ])
+
+def _prune_uneditable_fields(doc, allowed_fields):
+    for field in list(doc):
+        if field not in allowed_fields:
+            del doc[field]
+        elif isinstance(doc[field], dict):
+            _prune_uneditable_fields(doc[field], allowed_fields[field])
+
+def deepcopy_audit_updates(doc, changed_fields):
+    '''How audit updates were built before'''
+    updates = {}
+    doc = deepcopy(doc)
+    for field in changed_fields:
+        if field not in doc:
+            updates[field] = None
+            continue
+
+        if isinstance(doc[field], dict):
+            _prune_uneditable_fields(doc[field], ALLOWED_FIELDS[field])
+        elif isinstance(doc[field], list) and len(doc[field]) and isinstance(doc[field][0], dict):
+            for embedded in doc[field]:
+                _prune_uneditable_fields(embedded, ALLOWED_FIELDS[field])
+
+        updates[field] = doc[field]
+    return updates
+
+def audit_updates(doc, changed_fields):
+    return ModelView._audit_updates(doc, audit.ACTIONS.UPDATE, ALLOWED_FIELDS, changed_fields)
+
+def main():
+    list_length = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    iterations = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+
+    doc = make_doc(list_length)
+    print('%d embedded rows, %d updates' % (list_length, iterations))
+    for changed_fields in (['title'], ['owner'], ['rows'], ['title', 'owner', 'rows']):
+        assert audit_updates(doc, changed_fields) == deepcopy_audit_updates(doc, changed_fields)
+        print('changed %s' % ', '.join(changed_fields))
+        for name, fn in (('deepcopy', deepcopy_audit_updates), ('_audit_updates', audit_updates)):
+            seconds = min(timeit.repeat(lambda: fn(doc, changed_fields), number=iterations, repeat=3))
+            print('    %-15s %8.3f ms/update' % (name, seconds * 1000 / iterations))
+
+if __name__ == '__main__':
+    main()
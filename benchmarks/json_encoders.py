@@ -0,0 +1,79 @@
+'''Compares response encoding backends on payloads shaped like ModelView.get_list responses.
+
+    python benchmarks/json_encoders.py [num_objects] [iterations]
+
+"JsonResponse + default" is how responses were built before django_mongo_rest.encoders existed.'''
+import django, os, sys, timeit
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from django.conf import settings
+settings.configure(INSTALLED_APPS=['django.contrib.auth', 'django.contrib.contenttypes'])
+django.setup()
+
+from bson import ObjectId
+from django.http.response import HttpResponse, JsonResponse
+from django_mongo_rest import encoders
+from django_mongo_rest.utils import json_default_serializer
+from mongoengine.base.datastructures import BaseDict, BaseList
+
+def make_payload(num_objects):
+    start = datetime(2017, 1, 1)
+    objects = []
+    for i in range(num_objects):
+        objects.append({
+            'id': ObjectId(),
+            'name': 'object %d' % i,
+            'integer': i,
+            'created': start + timedelta(minutes=i),
+            'last_updated': start + timedelta(minutes=i, seconds=30),
+            'owner': {'id': ObjectId(), 'username': 'user%d' % (i % 10)},
+            'tags': BaseList(['tag%d' % (i % 7), 'tag%d' % (i % 3)], None, None),
+            'extra': BaseDict({'a': i, 'b': 'value'}, None, None),
+            'embedded': [{'val': j, 'when': start + timedelta(days=j)} for j in range(3)],
+        })
+    return {'objects': objects, 'num_matches': num_objects * 10}
+
+def make_decimal_payload(num_objects):
+    payload = make_payload(num_objects)
+    for obj in payload['objects']:
+        obj['price'] = Decimal('%d.99' % obj['integer'])
+    return payload
+
+def _old(payload):
+    return JsonResponse(payload, json_dumps_params={'default': json_default_serializer}).content
+
+def _new(backend):
+    def run(payload):
+        return HttpResponse(encoders.get_dumps(backend)(payload), content_type='application/json').content
+    return run
+
+def main():
+    num_objects = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    iterations = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+
+    candidates = [('JsonResponse + default', _old), ('encoders json', _new(encoders.JSON))]
+    try:
+        encoders.get_dumps(encoders.SIMPLEJSON)
+    except ImportError:
+        print('simplejson not installed, skipping it')
+    else:
+        candidates.append(('encoders simplejson', _new(encoders.SIMPLEJSON)))
+
+    payload = make_payload(num_objects)
+    print('%d objects per response, %d responses' % (num_objects, iterations))
+    for name, fn in candidates:
+        seconds = min(timeit.repeat(lambda: fn(payload), number=iterations, repeat=3))
+        print('%-25s %8.2f ms/response %8d bytes' % (name, seconds * 1000 / iterations, len(fn(payload))))
+
+    # The old path can't encode Decimals at all
+    payload = make_decimal_payload(num_objects)
+    print('\nWith Decimal fields')
+    for name, fn in candidates[1:]:
+        seconds = min(timeit.repeat(lambda: fn(payload), number=iterations, repeat=3))
+        print('%-25s %8.2f ms/response' % (name, seconds * 1000 / iterations))
+
+if __name__ == '__main__':
+    main()
@@ -1,26 +1,225 @@
-from django_mongo_rest.models import BaseModel
-from django_mongo_rest.utils import Enum
+'''Audit logs of inserts, updates and deletes.
+
+Records go to the sink chosen by the DMR_AUDIT_SINK setting:
+    'sync'   inserted before the request returns (default)
+    'async'  queued in memory and inserted in batches by a background thread. See AsyncSink
+
+When DMR_AUDIT_TTL is set, records are deleted that many seconds after they were written.
+DMR_AUDIT_WRITE_CONCERN (a pymongo WriteConcern or a dict such as {'w': 1}) lets audits use a lighter write
+concern than the documents they describe.
+
+reconstruct() rebuilds a document as it was at some point in time by replaying its records. Every
+DMR_AUDIT_SNAPSHOT_INTERVAL changes (100 by default) it stores a snapshot of the state so far, so later
+reconstructions replay at most that many records. Only records older than DMR_AUDIT_MAX_DELAY plus a margin
+are snapshotted, since records with earlier _ids may still be queued in an AsyncSink or another process.
+
+AuditView lets superusers page through the history of a document, a user or a model.'''
+import atexit
+import logging
+import os
+import threading
+import time
+import pytz
+from bson import ObjectId
+from datetime import datetime, timedelta
+from django.conf import settings
+from django_mongo_rest import ApiException
+from django_mongo_rest.auth import PERMISSION
+from django_mongo_rest.http import ApiView
+from django_mongo_rest.models import BaseModel, FindParams
+from django_mongo_rest.utils import Enum, encode_cursor, decode_cursor
+from django_mongo_rest.validation import Param
 from django_mongoengine.mongo_auth.managers import get_user_document
-from mongoengine import DynamicDocument, StringField, ReferenceField, ObjectIdField
+from mongoengine import DateTimeField, DynamicDocument, StringField, ReferenceField, ObjectIdField
+from six.moves import queue
+
+logger = logging.getLogger('django')
 
 class ACTIONS(Enum):
     CREATE = 'C'
     UPDATE = 'U'
     DELETE = 'D'
+    SNAPSHOT = 'S'  # Written by reconstruct. See _snapshot
+
+def _indexes():
+    # _id is last so that history is read in order straight from the index. See AuditView
+    indexes = [
+        ('model', 'doc_id', '-_id'),
+        ('user', '-_id'),
+        ('model', '-_id'),
+    ]
+    indexes.append({
+        'fields': ['model', 'doc_id', '-upto'],
+        'partialFilterExpression': {'action': ACTIONS.SNAPSHOT.value},
+    })
+    ttl = getattr(settings, 'DMR_AUDIT_TTL', None)
+    if ttl:
+        indexes.append({'fields': ['timestamp'], 'expireAfterSeconds': ttl})
+    return indexes
 
 class Audit(BaseModel, DynamicDocument):
 
     meta = {
-        'indexes': ['doc_id']
+        'indexes': _indexes()
     }
 
     user = ReferenceField(get_user_document())
     model = StringField()
     doc_id = ObjectIdField()
     action = StringField(choices=ACTIONS.choices_dict().items())
+    timestamp = DateTimeField()
 
-def create(request, action, model_class, doc, extra_data):
+SYNC = 'sync'
+ASYNC = 'async'
+
+def _write_concern():
+    return getattr(settings, 'DMR_AUDIT_WRITE_CONCERN', None)
+
+class SyncSink(object):
+    '''Inserts records right away'''
+    @staticmethod
+    def write(audit_docs):
+        if len(audit_docs) == 1:
+            Audit.insert_one(audit_docs[0], write_concern=_write_concern())
+        else:
+            Audit.insert_many(audit_docs, write_concern=_write_concern())
+
+    def flush(self):
+        pass
+
+_STOP = None  # Queued by AsyncSink.close to wake the flusher thread
+
+class AsyncSink(object):
+    '''Queues records and inserts them from a background thread, with one insert_many per batch_size records
+    or per flush_interval seconds, whichever comes first. Whatever is left is flushed at process exit.
+
+    Writes never block: when more than max_queue_size records are waiting, new ones are dropped. stats()
+    reports how many records were queued, written, dropped or failed, and how many took longer than
+    max_delay seconds to be written.'''
+    def __init__(self, max_queue_size=10000, batch_size=500, flush_interval=1.0, max_delay=10.0):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_delay = max_delay
+        self._queue = queue.Queue(max_queue_size)
+        self._stats = {'queued': 0, 'written': 0, 'dropped': 0, 'failed': 0, 'delayed': 0, 'max_delay': 0.0}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='dmr-audit')
+        self._thread.daemon = True
+        self._thread.start()
+        self._pid = os.getpid()
+        atexit.register(self._close_at_exit)
+
+    def _close_at_exit(self):
+        # A forked child inherits this handler and a copy of the queue, whose records the parent writes
+        if os.getpid() == self._pid:
+            self.close()
+
+    def _count(self, stat, n=1):
+        with self._lock:
+            self._stats[stat] += n
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, pending=self._queue.qsize())
+
+    def write(self, audit_docs):
+        for audit_doc in audit_docs:
+            try:
+                self._queue.put_nowait((time.time(), audit_doc))
+            except queue.Full:
+                self._count('dropped')
+                logger.error('Audit queue is full. Dropped audit record %s', audit_doc)
+            else:
+                self._count('queued')
+
+    def _take_batch(self, timeout, limit):
+        '''Waits up to timeout seconds for the first record, then takes what is queued, up to limit records.
+        Stops at _STOP.'''
+        batch = []
+        try:
+            item = self._queue.get(timeout=timeout) if timeout else self._queue.get_nowait()
+            while item is not _STOP:
+                batch.append(item)
+                if len(batch) >= limit:
+                    break
+                item = self._queue.get_nowait()
+        except queue.Empty:
+            pass
+        return batch
+
+    def _write_batch(self, batch):
+        try:
+            Audit.insert_many([audit_doc for _, audit_doc in batch], ordered=False, write_concern=_write_concern())
+        except Exception:  # pylint: disable=broad-except
+            self._count('failed', len(batch))
+            logger.exception('Failed to write %d audit records', len(batch))
+            return
+
+        written_at = time.time()
+        delay = written_at - batch[0][0]
+        delayed = sum(1 for queued_at, _ in batch if written_at - queued_at > self.max_delay)
+        with self._lock:
+            self._stats['written'] += len(batch)
+            self._stats['delayed'] += delayed
+            self._stats['max_delay'] = max(self._stats['max_delay'], delay)
+        if delayed:
+            logger.warning('%d audit records were written up to %.1f seconds late', delayed, delay)
+
+    def _run(self):
+        while not self._closed.is_set():
+            deadline = time.time() + self.flush_interval
+            batch = self._take_batch(self.flush_interval, self.batch_size)
+            # Let the batch fill up until the interval is over, unless closing
+            while batch and len(batch) < self.batch_size and not self._closed.is_set():
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                batch.extend(self._take_batch(remaining, self.batch_size - len(batch)))
+            if batch:
+                with self._flush_lock:
+                    self._write_batch(batch)
+
+    def flush(self):
+        '''Writes everything queued so far'''
+        with self._flush_lock:
+            batch = self._take_batch(None, self.batch_size)
+            while batch:
+                self._write_batch(batch)
+                batch = self._take_batch(None, self.batch_size)
+
+    def close(self):
+        self._closed.set()
+        try:
+            self._queue.put_nowait(_STOP)
+        except queue.Full:
+            pass  # Then the thread isn't waiting for records
+        self._thread.join(self.flush_interval + 1)
+        self.flush()
+
+_sink = None
+_sink_pid = None
+
+def get_sink():
+    global _sink, _sink_pid  # pylint: disable=global-statement
+    # A forked process doesn't get the parent's flusher thread, so it needs its own sink
+    if _sink is None or _sink_pid != os.getpid():
+        if getattr(settings, 'DMR_AUDIT_SINK', SYNC) == ASYNC:
+            _sink = AsyncSink(max_queue_size=getattr(settings, 'DMR_AUDIT_QUEUE_SIZE', 10000),
+                              batch_size=getattr(settings, 'DMR_AUDIT_BATCH_SIZE', 500),
+                              flush_interval=getattr(settings, 'DMR_AUDIT_FLUSH_INTERVAL', 1.0),
+                              max_delay=getattr(settings, 'DMR_AUDIT_MAX_DELAY', 10.0))
+        else:
+            _sink = SyncSink()
+        _sink_pid = os.getpid()
+    return _sink
+
+def _audit_doc(request, action, model_class, doc, extra_data):
     audit_doc = {
+        # Generated now rather than on insert, so its timestamp is when the change happened
+        '_id': ObjectId(),
+        'timestamp': datetime.utcnow(),
         'user': request.user.id,
         'model': model_class.get_collection_name(),
         'action': action.value,
@@ -28,7 +227,100 @@ def create(request, action, model_class, doc, extra_data):
     }
 
     audit_doc.update(extra_data)
-    Audit.insert_one(audit_doc)
+    return audit_doc
+
+def create(request, action, model_class, doc, extra_data):
+    get_sink().write([_audit_doc(request, action, model_class, doc, extra_data)])
+
+def create_many(request, action, model_class, docs):
+    '''docs is a list of (doc, extra_data). Written with a single insert'''
+    audit_docs = [_audit_doc(request, action, model_class, doc, extra_data) for doc, extra_data in docs]
+    if audit_docs:
+        get_sink().write(audit_docs)
+
+# Fields of every record, as opposed to the fields of the audited document
+RECORD_FIELDS = frozenset(('_id', 'timestamp', 'user', 'model', 'action', 'doc_id'))
+
+def _replay(state, record):
+    '''Returns the state after record. None means the document doesn't exist'''
+    action = record['action']
+    if action == ACTIONS.DELETE.value:
+        return None
+
+    changes = {k: v for k, v in record.iteritems() if k not in RECORD_FIELDS}
+    if action == ACTIONS.CREATE.value or state is None:
+        state = {}
+    for k, v in changes.iteritems():
+        if v is None:
+            state.pop(k, None)
+        else:
+            state[k] = v
+    return state
+
+def _snapshot(model, doc_id, state, upto):
+    snapshot = {
+        '_id': ObjectId(),
+        'timestamp': datetime.utcnow(),
+        'model': model,
+        'doc_id': doc_id,
+        'action': ACTIONS.SNAPSHOT.value,
+        'state': state,
+        'upto': upto,  # _id of the last record included in state
+    }
+    Audit.insert_one(snapshot, write_concern=_write_concern())
+
+# Seconds added to DMR_AUDIT_MAX_DELAY before a record is old enough to snapshot
+SNAPSHOT_MARGIN = 60
+
+def _snapshot_before():
+    '''Records with _ids below this can be snapshotted. Later ones may still have earlier records on their way'''
+    min_age = getattr(settings, 'DMR_AUDIT_MAX_DELAY', 10.0) + SNAPSHOT_MARGIN
+    return ObjectId.from_datetime(datetime.utcnow() - timedelta(seconds=min_age))
+
+def _as_naive_utc(dt):
+    if dt.tzinfo:
+        dt = dt.astimezone(pytz.utc).replace(tzinfo=None)
+    return dt
+
+def reconstruct(model, doc_id, at, max_time_ms=None):
+    '''The audited fields of a document as they were at datetime at (UTC when naive), or None if it didn't
+    exist then. model is a model class or collection name. max_time_ms applies to each query.
+
+    Only fields that were audited are known, so this is what views with audit on let users edit.'''
+    if not isinstance(model, (str, unicode)):
+        model = model.get_collection_name()
+    at = _as_naive_utc(at)
+    # _ids hold whole seconds, so records of the last second are checked against their timestamp
+    second = ObjectId.from_datetime(at.replace(microsecond=0))
+    before = ObjectId.from_datetime(at.replace(microsecond=0) + timedelta(seconds=1))
+    lookup = {'model': model, 'doc_id': doc_id}
+
+    params = FindParams(sort=[('upto', -1)], limit=1, max_time_ms=max_time_ms)
+    latest = next(Audit.find(params=params, action=ACTIONS.SNAPSHOT.value, **lookup), None)
+    snapshot = latest
+    if latest and latest['upto'] >= second:
+        snapshot = next(Audit.find(params=params, action=ACTIONS.SNAPSHOT.value, upto={'$lt': second},
+                                   **lookup), None)
+    state = snapshot['state'] if snapshot else None
+    id_range = {'$lt': before}
+    if snapshot:
+        id_range['$gt'] = snapshot['upto']
+
+    interval = getattr(settings, 'DMR_AUDIT_SNAPSHOT_INTERVAL', 100)
+    snapshot_before = _snapshot_before()
+    replayed = 0
+    records = Audit.find(params=FindParams(sort=[('_id', 1)], max_time_ms=max_time_ms), _id=id_range,
+                         action={'$ne': ACTIONS.SNAPSHOT.value}, **lookup)
+    for record in records:
+        if record.get('timestamp', at) > at:
+            break
+        state = _replay(state, record)
+        replayed += 1
+        # Don't snapshot what's already covered by a later snapshot, or what is too recent
+        if (interval and replayed % interval == 0 and record['_id'] < snapshot_before and
+                (not latest or record['_id'] > latest['upto'])):
+            _snapshot(model, doc_id, state, record['_id'])
+    return state
 
 def update(request, model_class, doc, updates):
     for k, v in updates.iteritems():
@@ -36,3 +328,63 @@ def update(request, model_class, doc, updates):
 
     model_class.update_by_id(doc['_id'], **updates)
     create(request, ACTIONS.UPDATE, model_class, doc, updates)
+
+class AuditView(ApiView):
+    '''GET ?model=&doc_id= for the history of a document, ?user= for what a user did (optionally within
+    ?model=), or ?model= for the history of a whole collection. Newest first.
+
+    With ?at=<unix timestamp>, model and doc_id, returns {"object": ...}, the document as it was then. See
+    reconstruct.
+
+    Returns {"objects": [...], "next": token}. Pass next back as ?after= for the following page. Pages are read
+    straight from the indexes on Audit, so deep pages are as fast as the first one.'''
+    permissions = PERMISSION.SUPERUSER
+    allowed_methods = ['GET']
+    params = (
+        Param('model'),
+        Param('doc_id', type_cast=ObjectId),
+        Param('user', type_cast=ObjectId),
+        Param('after'),
+        Param('cnt', type_cast=int, min=1, max=1000),
+        Param('at', type_cast=float),
+    )
+    default_limit = 50
+    SORT = [('_id', -1)]
+
+    def main(self, request, model=None, doc_id=None, user=None, after=None, cnt=None, at=None):
+        # pylint: disable=too-many-arguments
+        if doc_id and not model:
+            raise ApiException('doc_id requires model', 400)
+        if not model and not user:
+            raise ApiException('Expected doc_id and model, user or model', 400)
+
+        if at is not None:
+            if not doc_id:
+                raise ApiException('at requires model and doc_id', 400)
+            obj = reconstruct(model, doc_id, datetime.utcfromtimestamp(at), max_time_ms=self.max_time_ms)
+            return {'object': obj}
+
+        query = {k: v for k, v in (('model', model), ('doc_id', doc_id), ('user', user)) if v}
+        query['action'] = {'$ne': ACTIONS.SNAPSHOT.value}
+        if after:
+            try:
+                sort, values = decode_cursor(after)
+            except ValueError:
+                raise ApiException('Invalid after token', 400)
+            if (sort != self.SORT or not isinstance(values, list) or len(values) != 1 or
+                    not isinstance(values[0], ObjectId)):
+                raise ApiException('Invalid after token', 400)
+            query['_id'] = {'$lt': values[0]}
+
+        limit = cnt or self.default_limit
+        params = FindParams(sort=self.SORT, limit=limit + 1, read_preference=self.read_preference,
+                            max_time_ms=self.max_time_ms)
+        objs = list(Audit.find(params=params, **query))
+        next_token = None
+        if len(objs) > limit:
+            objs = objs[:limit]
+            next_token = encode_cursor(self.SORT, [objs[-1]['_id']])
+
+        for obj in objs:
+            obj['id'] = obj.pop('_id')
+        return {'objects': objs, 'next': next_token}
@@ -0,0 +1,149 @@
+'''Cross-request read-through cache of documents, for models that are read far more often than written.
+
+A model opts in through its meta:
+    meta = {'cache': True}  # or {'cache': {'max_size': 5000, 'ttl': 300}}
+
+Then find_one by id and find_by_id keep what they read in an in-process LRU cache, keyed by id and projection,
+for ttl seconds. Only reads without a permission scope are cached. Any write through BaseModel empties the
+model's cache, but writes from other processes are only seen once entries expire.
+
+A model can also opt in to a shared cache of the documents serialize fetches when it dereferences foreign
+keys to that model, such as created_by -> User:
+    meta = {'dereference_cache': True}  # or {'dereference_cache': {'max_size': 5000, 'ttl': 300}}
+Those reads never have a permission scope. Only the ids that aren't cached are queried.
+
+max_size and ttl default to the DMR_DOCUMENT_CACHE_SIZE and DMR_DOCUMENT_CACHE_TTL settings (1000 documents
+and 60 seconds). stats() reports hits and misses per collection.'''
+import threading
+import time
+from collections import OrderedDict
+from copy import deepcopy
+from django.conf import settings
+
+class LRUCache(object):
+    '''Thread safe. Entries expire ttl seconds after they were set, and the least recently used entries are
+    evicted beyond max_size.'''
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (expires, value)
+        self._lock = threading.Lock()
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def generation(self):
+        '''Pass to set, so that a value read before a clear() isn't cached after it'''
+        return self._generation
+
+    def get(self, key):
+        '''Returns (found, value)'''
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[0] < time.time():
+                self.misses += 1
+                return False, None
+            self._entries[key] = entry  # Most recently used
+            self.hits += 1
+            return True, entry[1]
+
+    def set(self, key, value, generation):
+        with self._lock:
+            if generation != self._generation:
+                return
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + self.ttl, value)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._generation += 1
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries)}
+
+class DocumentCache(LRUCache):
+    '''Documents by (id, projection). Documents are copied in and out, so callers can modify them.'''
+    @staticmethod
+    def _key(doc_id, projection):
+        try:
+            key = (doc_id, frozenset(projection.items()) if projection else None)
+            hash(key)
+        except (AttributeError, TypeError):
+            return None
+        return key
+
+    def get_doc(self, doc_id, projection):
+        '''Returns (found, doc)'''
+        key = self._key(doc_id, projection)
+        if key is None:
+            return False, None
+        found, doc = self.get(key)
+        return found, deepcopy(doc)
+
+    def set_doc(self, doc_id, projection, doc, generation):
+        key = self._key(doc_id, projection)
+        if key is not None:
+            self.set(key, deepcopy(doc), generation)
+
+    def get_docs(self, doc_ids, projection):
+        '''Returns ({id: doc} of the cached documents that exist, [ids that aren't cached])'''
+        docs = {}
+        missing = []
+        for doc_id in doc_ids:
+            found, doc = self.get_doc(doc_id, projection)
+            if not found:
+                missing.append(doc_id)
+            elif doc is not None:
+                docs[doc_id] = doc
+        return docs, missing
+
+    def set_docs(self, doc_ids, projection, docs, generation):
+        '''docs is {id: doc} of what was found for doc_ids. The others are cached as not existing'''
+        for doc_id in doc_ids:
+            self.set_doc(doc_id, projection, docs.get(doc_id), generation)
+
+CACHE = 'cache'
+DEREFERENCE_CACHE = 'dereference_cache'
+
+_caches = {}  # (model, CACHE or DEREFERENCE_CACHE) -> DocumentCache
+_caches_lock = threading.Lock()
+
+def get_cache(model, kind=CACHE):
+    '''model's DocumentCache of that kind, or None if it doesn't use one'''
+    config = model._meta.get(kind)
+    if not config:
+        return None
+
+    doc_cache = _caches.get((model, kind))
+    if doc_cache is None:
+        config = config if isinstance(config, dict) else {}
+        with _caches_lock:
+            doc_cache = _caches.get((model, kind))
+            if doc_cache is None:
+                doc_cache = DocumentCache(
+                    max_size=config.get('max_size', getattr(settings, 'DMR_DOCUMENT_CACHE_SIZE', 1000)),
+                    ttl=config.get('ttl', getattr(settings, 'DMR_DOCUMENT_CACHE_TTL', 60)))
+                _caches[(model, kind)] = doc_cache
+    return doc_cache
+
+def get_dereference_cache(model):
+    return get_cache(model, DEREFERENCE_CACHE)
+
+def cacheable(params):
+    '''Whether a read with these FindParams sees the same documents for everyone'''
+    return params.request is None or params.request.user.is_superuser
+
+def invalidate(model):
+    for kind in (CACHE, DEREFERENCE_CACHE):
+        doc_cache = _caches.get((model, kind))
+        if doc_cache is not None:
+            doc_cache.clear()
+
+def stats(kind=CACHE):
+    '''{collection name: {'hits': ..., 'misses': ..., 'size': ...}}'''
+    return {model.get_collection_name(): doc_cache.stats()
+            for (model, cache_kind), doc_cache in _caches.items() if cache_kind == kind}
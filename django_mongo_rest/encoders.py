@@ -0,0 +1,79 @@
+'''JSON encoding of api responses.
+
+The backend is picked with the DMR_JSON_ENCODER setting:
+    'json'        stdlib json (default)
+    'simplejson'  simplejson with its C speedups
+    anything else a dotted path to a dumps(obj) callable
+
+ObjectId, datetime and Decimal are written as strings, the same with either backend, so Decimals keep their
+exact digits. Neither C encoder knows these types, so they go through default, which is one dict lookup for
+them. mongoengine's BaseList and BaseDict subclass list and dict, so they are encoded as such without going
+through default.'''
+import json
+from bson import ObjectId
+from datetime import datetime
+from decimal import Decimal
+from django.conf import settings
+from django.http.response import HttpResponse
+from django.utils.module_loading import import_string
+from django_mongo_rest.utils import json_default_serializer
+
+JSON = 'json'
+SIMPLEJSON = 'simplejson'
+
+# Looked up by exact type first, which is the common case, before falling back to isinstance
+_TYPE_ENCODERS = {
+    ObjectId: ObjectId.__str__,
+    datetime: datetime.__str__,
+    Decimal: Decimal.__str__,
+}
+
+def default(obj, _get_encoder=_TYPE_ENCODERS.get):
+    encode = _get_encoder(type(obj))
+    if encode is None:
+        for cls, cls_encode in _TYPE_ENCODERS.iteritems():
+            if isinstance(obj, cls):
+                encode = cls_encode
+                break
+        else:
+            return json_default_serializer(obj)
+    return encode(obj)
+
+def _stdlib_dumps():
+    encoder = json.JSONEncoder(default=default, separators=(',', ':'))
+    return encoder.encode
+
+def _simplejson_dumps():
+    # use_decimal, on by default, would write Decimals as numbers instead of going through default
+    import simplejson
+    encoder = simplejson.JSONEncoder(default=default, separators=(',', ':'), use_decimal=False)
+    return encoder.encode
+
+_BACKENDS = {
+    JSON: _stdlib_dumps,
+    SIMPLEJSON: _simplejson_dumps,
+}
+
+_dumps_cache = {}
+
+def get_dumps(backend=None):
+    '''Returns the dumps(obj) callable of backend, defaulting to the DMR_JSON_ENCODER setting'''
+    if backend is None:
+        backend = getattr(settings, 'DMR_JSON_ENCODER', JSON)
+    try:
+        return _dumps_cache[backend]
+    except KeyError:
+        pass
+
+    if backend in _BACKENDS:
+        dumps_fn = _BACKENDS[backend]()
+    else:
+        dumps_fn = import_string(backend)
+    _dumps_cache[backend] = dumps_fn
+    return dumps_fn
+
+def dumps(obj):
+    return get_dumps()(obj)
+
+def json_response(data, status=200):
+    return HttpResponse(dumps(data), content_type='application/json', status=status)
@@ -2,12 +2,14 @@ import json
 from django.conf import settings
 from django.contrib.auth.views import redirect_to_login
 from django.shortcuts import redirect
-from django.http.response import HttpResponse, Http404, JsonResponse
+from django.http.response import HttpResponse, Http404
 from django_mongo_rest import ApiException
 from django_mongo_rest.auth import is_authorized
 from django_mongo_rest.crypto import verify_signature, InvalidSig, ExpiredSig
-from django_mongo_rest.utils import to_list, json_default_serializer
+from django_mongo_rest.encoders import json_response
+from django_mongo_rest.utils import to_list
 from django_mongo_rest.validation import get_params
+from pymongo.errors import ExecutionTimeout
 
 def _enforce_allowed_methods(request, allowed_methods):
     if hasattr(allowed_methods, '__call__'):
@@ -43,6 +45,7 @@ class ERROR_CODES(object):
     EXPIRED_SIGNATURE = 'SIG_EXP'
     PERMISSION = 'PERM'
     PARAMS = 'PARAMS'
+    TIMEOUT = 'TIMEOUT'
 
 class _EndpointView(object):
     allowed_methods = None
@@ -98,16 +101,31 @@ class _EndpointView(object):
 class ApiView(_EndpointView):
     expected_content_type = 'application/json'
 
+    '''Collection options for this view, applied with collection.with_options. read_preference (a pymongo
+    ReadPreference) is used for lists and counts, so they can go to secondaries while reads by id stay on the
+    primary. max_time_ms cancels any read of this view that runs longer. write_concern (a pymongo WriteConcern
+    or a dict such as {'w': 1}) is used for every write.'''
+    read_preference = None
+    max_time_ms = None
+    write_concern = None
+
     def main_wrapper(self, request, *args, **kwargs):
-        res = self.main(request, *args, **kwargs)
+        try:
+            res = self.main(request, *args, **kwargs)
+        except ExecutionTimeout:
+            # A query ran longer than its max_time_ms
+            raise ApiException('The request took too long', 503, error_code=ERROR_CODES.TIMEOUT)
 
         if isinstance(res, dict):
-            res = JsonResponse(res, json_dumps_params={'default': json_default_serializer})
+            res = json_response(res)
         elif res is None:
             res = HttpResponse()
 
         if request.method == 'HEAD':
-            res.content = ''
+            if res.streaming:
+                res.streaming_content = []
+            else:
+                res.content = ''
 
         return res
 
@@ -0,0 +1,104 @@
+'''Idempotency-Key support.
+
+A client that sends the same Idempotency-Key header again, i.e. when retrying after a timeout, gets the
+response of the first request instead of running it twice. Keys are per user and scope, and are forgotten
+after DMR_IDEMPOTENCY_KEY_TTL seconds (one day by default).'''
+from bson import ObjectId
+from datetime import datetime, timedelta
+from hashlib import sha1
+from django.conf import settings
+from django.http.response import HttpResponse
+from django_mongo_rest import ApiException
+from django_mongo_rest.encoders import dumps
+from django_mongo_rest.models import BaseModel
+from mongoengine import DateTimeField, DynamicField, IntField, ObjectIdField, StringField
+from pymongo.errors import DuplicateKeyError
+
+HEADER = 'HTTP_IDEMPOTENCY_KEY'
+MAX_KEY_LENGTH = 255
+
+class STATES(object):
+    IN_PROGRESS = 'in_progress'
+    DONE = 'done'
+
+class IdempotencyKey(BaseModel):
+    meta = {
+        'indexes': [{
+            'fields': ['key', 'user', 'scope'],
+            'unique': True,
+        }, {
+            'fields': ['created'],
+            'expireAfterSeconds': getattr(settings, 'DMR_IDEMPOTENCY_KEY_TTL', 24 * 60 * 60),
+        }]
+    }
+
+    key = StringField()
+    user = DynamicField()
+    scope = StringField()
+    request_hash = StringField()
+    state = StringField()
+    lease = ObjectIdField()  # Identifies the request running with this key
+    lease_expires = DateTimeField()
+    status = IntField()
+    response = StringField()  # The json response body
+    created = DateTimeField()
+
+def get_key(request):
+    key = request.META.get(HEADER)
+    if key and len(key) > MAX_KEY_LENGTH:
+        raise ApiException('Idempotency-Key must be at most %d characters' % MAX_KEY_LENGTH, 400)
+    return key
+
+def _lease_expires():
+    return datetime.utcnow() + timedelta(seconds=getattr(settings, 'DMR_IDEMPOTENCY_LEASE', 60))
+
+def _claim(lookup, request_hash):
+    '''Returns the lease id when this request may run, or None when the key is done or held by another
+    request'''
+    lease = ObjectId()
+    try:
+        IdempotencyKey.insert_one(dict(lookup, request_hash=request_hash, state=STATES.IN_PROGRESS, lease=lease,
+                                       lease_expires=_lease_expires(), created=datetime.utcnow()))
+        return lease
+    except DuplicateKeyError:
+        pass
+
+    # Take over a claim whose request died without releasing it
+    taken = IdempotencyKey.find_one_and_update(
+        dict(lookup, request_hash=request_hash, state=STATES.IN_PROGRESS,
+             lease_expires={'$lt': datetime.utcnow()}),
+        {'lease': lease, 'lease_expires': _lease_expires()}, projection={'_id': 1})
+    return lease if taken else None
+
+def run(request, scope, key, func):
+    '''Runs func() the first time key is seen, and stores the dict it returns.
+    Later requests with the same key replay the stored response without calling func.
+
+    While func runs the key is leased for DMR_IDEMPOTENCY_LEASE seconds (60 by default). If the process dies
+    before storing a response, a retry after the lease expires runs func again.'''
+    lookup = {'key': key, 'user': request.user.id, 'scope': scope}
+    request_hash = sha1(request.body).hexdigest()
+    lease = _claim(lookup, request_hash)
+    if lease is None:
+        return _replay(lookup, request_hash)
+
+    res = None
+    try:
+        res = func()
+    finally:
+        if isinstance(res, dict):
+            IdempotencyKey.update_one(dict(lookup, lease=lease), state=STATES.DONE, status=200,
+                                      response=dumps(res))
+        else:
+            # Nothing to store, so let the client retry with the same key
+            IdempotencyKey.delete_one(lease=lease, **lookup)
+    return res
+
+def _replay(lookup, request_hash):
+    stored = IdempotencyKey.find_one(**lookup)
+    if stored and stored['request_hash'] != request_hash:
+        raise ApiException('Idempotency-Key was already used for a different request', 422, 'IDEMPOTENCY_MISMATCH')
+    if not stored or stored['state'] == STATES.IN_PROGRESS:
+        raise ApiException('A request with this Idempotency-Key is in progress', 409, 'IDEMPOTENCY_IN_PROGRESS')
+
+    return HttpResponse(stored['response'], content_type='application/json', status=stored['status'])
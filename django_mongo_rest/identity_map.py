@@ -0,0 +1,82 @@
+'''Request scoped identity map.
+
+While one is active, BaseModel.find_one (by id), find_by_id and find_by_ids remember the documents they
+fetched, so asking for the same id again in the same request doesn't query mongo. Entries are keyed by
+model, id, permission scope and projection. Any write through BaseModel forgets every entry of that model.
+
+Activate it for every request with IdentityMapMiddleware, or around some code with
+    with identity_map.activate():
+        ...
+
+Documents are copied in and out of the map, so callers can modify what they get back.'''
+import threading
+from contextlib import contextmanager
+from copy import deepcopy
+
+_local = threading.local()
+
+class IdentityMap(object):
+    def __init__(self):
+        self._docs = {}  # model -> {(id, scope, projection): doc or None when it doesn't exist}
+
+    @staticmethod
+    def _key(doc_id, params):
+        '''None when this lookup can't be mapped'''
+        request = params.request
+        scope = id(request) if request and not request.user.is_superuser else None
+        try:
+            projection = frozenset(params.projection.items()) if params.projection else None
+            key = (doc_id, scope, projection)
+            hash(key)
+        except (AttributeError, TypeError):
+            return None
+        return key
+
+    def get(self, model, doc_id, params):
+        '''Returns (found, doc)'''
+        key = self._key(doc_id, params)
+        if key is None:
+            return False, None
+
+        docs = self._docs.get(model, {})
+        if key in docs:
+            return True, deepcopy(docs[key])
+
+        # A whole document answers any projection
+        whole_key = key[:2] + (None,)
+        if whole_key in docs:
+            return True, deepcopy(docs[whole_key])
+        return False, None
+
+    def set(self, model, doc_id, params, doc):
+        key = self._key(doc_id, params)
+        if key is not None:
+            self._docs.setdefault(model, {})[key] = deepcopy(doc)
+
+    def invalidate(self, model):
+        self._docs.pop(model, None)
+
+def get_identity_map():
+    '''The active IdentityMap, or None'''
+    return getattr(_local, 'identity_map', None)
+
+def start():
+    previous = get_identity_map()
+    _local.identity_map = IdentityMap()
+    return previous
+
+def stop(previous=None):
+    _local.identity_map = previous
+
+@contextmanager
+def activate():
+    previous = start()
+    try:
+        yield get_identity_map()
+    finally:
+        stop(previous)
+
+def invalidate(model):
+    identity_map = get_identity_map()
+    if identity_map is not None:
+        identity_map.invalidate(model)
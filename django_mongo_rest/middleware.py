@@ -1,8 +1,7 @@
 import logging
-from django.http.response import JsonResponse
 from django.utils.deprecation import MiddlewareMixin
-from django_mongo_rest import ApiException
-from django_mongo_rest.utils import json_default_serializer
+from django_mongo_rest import ApiException, identity_map
+from django_mongo_rest.encoders import json_response
 
 logger = logging.getLogger('django')
 
@@ -13,5 +12,15 @@ class ApiExceptionMiddleware(MiddlewareMixin):
             if exception.status_code == 500:
                 logger.exception(exception)
 
-            return JsonResponse(exception.__dict__, status=exception.status_code,
-                                json_dumps_params={'default': json_default_serializer})
+            return json_response(exception.__dict__, status=exception.status_code)
+
+class IdentityMapMiddleware(MiddlewareMixin):
+    '''Gives every request its own identity map. See django_mongo_rest.identity_map'''
+    @staticmethod
+    def process_request(request):
+        request.dmr_previous_identity_map = identity_map.start()
+
+    @staticmethod
+    def process_response(request, response):
+        identity_map.stop(getattr(request, 'dmr_previous_identity_map', None))
+        return response
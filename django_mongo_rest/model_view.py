@@ -1,31 +1,42 @@
+import calendar
+import hashlib
 import pytz
-from bson import ObjectId
+from bson import ObjectId, SON
+from bson.errors import InvalidId
 from collections import namedtuple
 from copy import deepcopy
+from itertools import islice
 from datetime import datetime
-from django.http.response import Http404
+from django.core.cache import cache
+from django.http.response import Http404, HttpResponseNotModified, StreamingHttpResponse
+from django.utils.http import http_date, parse_http_date_safe
 from django.utils.timezone import now
-from django_mongo_rest import serialize, ApiException, ApiView, audit
+from django_mongo_rest import serialize, ApiException, ApiView, audit, idempotency, versions
+from django_mongo_rest.serialize import get_foreign_models, get_projection
 from django_mongo_rest.models import FindParams, UpdateParams, ModelPermissionException
 from django_mongo_rest.shortcuts import get_object_or_404, get_orm_object_or_404_by_id
-from django_mongo_rest.utils import pluralize
+from django_mongo_rest.encoders import get_dumps, json_response
+from django_mongo_rest.utils import pluralize, encode_cursor, decode_cursor, query_hash, choices_maps
 from mongoengine import (ReferenceField, StringField, EmbeddedDocumentListField, ListField, BooleanField,
                          ObjectIdField)
 from mongoengine.errors import ValidationError
-from pymongo.errors import DuplicateKeyError
-from six import string_types
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from six import integer_types, string_types
 
 model_registry = {}
 
+DEFAULT_LIMIT = 10
+DUPLICATE_KEY_ERROR_CODES = (11000, 11001)
+
 class ImproperlyConfigured(Exception):
     pass
 
 def _get_duplicate_model(model_class, model):
-    for idx in model_class.get_unique_indices():
-        query = {field: model.get(field) for field, _ in idx['fields']}
-        duplicate = model_class.find_one(**query)
-        if duplicate:
-            return duplicate
+    queries = [{field: model.get(field) for field, _ in idx['fields']}
+               for idx in model_class.get_unique_indices()]
+    if not queries:
+        return None
+    return model_class.find_one(**{'$or': queries})
 
 def remove_empty_lists(doc):
     for k, v in doc.items():
@@ -34,18 +45,68 @@ def remove_empty_lists(doc):
         elif isinstance(v, dict):
             remove_empty_lists(v)
 
-def _extract_embedded_document_list(request, field, input_list, allowed_fields, permission_exempt_fields):
+# A reference that must exist. path leads to the field in the errors dict, i.e. ('embedded_list', 3, 'ref').
+# request is None when the reference is exempt from permissions.
+_ReferenceCheck = namedtuple('_ReferenceCheck', 'path document_type request value')
+
+def _set_error(errors, path, error):
+    for key in path[:-1]:
+        errors = errors.setdefault(key, {})
+        if not isinstance(errors, dict):
+            # There is already an error for a parent
+            return
+    errors.setdefault(path[-1], error)
+
+def _check_references(reference_checks, errors):
+    '''Checks every reference gathered while extracting a request model with one $in query per referenced
+    model and permission scope, and adds an error for each one that is missing'''
+    groups = {}
+    for check in reference_checks:
+        groups.setdefault((check.document_type, check.request), []).append(check)
+
+    for (document_type, request), checks in groups.iteritems():
+        ids = [c.value for c in checks]
+        if isinstance(document_type.id, ObjectIdField):
+            # Anything else can't be an id, and find_by_ids would refuse it
+            ids = [i for i in ids if isinstance(i, ObjectId)]
+
+        params = FindParams(request=request, projection={'_id': 1})
+        try:
+            found = {doc['_id'] for doc in document_type.find_by_ids(ids, params=params)} if ids else set()
+        except ModelPermissionException:
+            found = set()
+
+        for check in checks:
+            try:
+                exists = check.value in found
+            except TypeError:  # Unhashable, so not an id
+                exists = False
+            if not exists:
+                _set_error(errors, check.path, document_type.msg404(obj_id=check.value))
+
+def _editable_subset(embedded, allowed_fields):
+    '''Copy of an embedded document with only its allowed fields. Other values are shared, not copied'''
+    return {field: _editable_subset(value, allowed_fields[field]) if isinstance(value, dict) else value
+            for field, value in embedded.iteritems() if field in allowed_fields}
+
+def _extract_embedded_document_list(request, field, input_list, allowed_fields, permission_exempt_fields,
+                                    reference_checks):
+    # pylint: disable=too-many-arguments
     document_type = field.field.document_type
     the_list = []
     errors = {}
     for i, subdoc in enumerate(input_list):
         subdoc_errors = {}
+        subdoc_reference_checks = []
         subdoc = _extract_request_model_recursive(document_type, request, subdoc, allowed_fields,
-                                                  subdoc_errors, [], permission_exempt_fields)
+                                                  subdoc_errors, [], permission_exempt_fields,
+                                                  subdoc_reference_checks)
         if subdoc_errors:
             errors[i] = subdoc_errors
             continue
 
+        reference_checks.extend(check._replace(path=(i,) + check.path) for check in subdoc_reference_checks)
+
         if subdoc.to_mongo():
             the_list.append(subdoc)
 
@@ -55,25 +116,22 @@ def _extract_embedded_document_list(request, field, input_list, allowed_fields,
     return the_list
 
 def _display_to_enum(field, val):
-    choices = getattr(field, 'choices', None)
-    if not choices:
+    maps = choices_maps(field)
+    if not maps:
         return None
 
-    choices_dict = {c[1].lower(): c[0] for c in choices}
     try:
-        return choices_dict[val.lower()]
+        return maps.from_display[val.lower()]
     except KeyError:
-        error_msg = 'Must be one of %s' % str([k.lower() for k in choices_dict.keys()])
-        raise ValidationError(errors=error_msg)
+        raise ValidationError(errors='Must be one of %s' % str(maps.from_display.keys()))
 
-def _process_value(request, field, val, allowed_fields, permission_exempt_fields):
+def _process_value(request, field, val, allowed_fields, permission_exempt_fields, reference_checks):
+    # pylint: disable=too-many-arguments
     if isinstance(field, ReferenceField):
-        kwargs = {}
-        if field.name not in permission_exempt_fields:
-            kwargs['request'] = request
-
-        if not field.document_type.exists(id=val, **kwargs):
-            raise ValidationError(errors=field.document_type.msg404(obj_id=val))
+        # Existence is checked for the whole request at once, by _check_references
+        scope = None if field.name in permission_exempt_fields else request
+        reference_checks.append(_ReferenceCheck((), field.document_type, scope,
+                                                field.document_type.id.to_python(val)))
         return field.to_python(val)
 
     elif isinstance(field, StringField):
@@ -85,22 +143,20 @@ def _process_value(request, field, val, allowed_fields, permission_exempt_fields
             return enum_val
     elif isinstance(field, EmbeddedDocumentListField):
         return _extract_embedded_document_list(request, field, val or [], allowed_fields[field.name],
-                                               permission_exempt_fields)
+                                               permission_exempt_fields, reference_checks)
 
     elif isinstance(field, ListField):
-        choices = getattr(field.field, 'choices', None)
-        if choices:
-            choices_dict = {c[1].lower(): c[0] for c in choices}
+        maps = choices_maps(field.field)
+        if maps:
             try:
-                return [choices_dict[v.lower()] for v in val]
+                return [maps.from_display[v.lower()] for v in val]
             except KeyError:
-                error_msg = 'Must be one of %s' % str([k.lower() for k in choices_dict.keys()])
-                raise ValidationError(errors=error_msg)
+                raise ValidationError(errors='Must be one of %s' % str(maps.from_display.keys()))
 
     return val
 
 def _extract_request_model_field(request, doc, input_data, field, allowed_fields, errors, changed_fields,
-                                 permission_exempt_fields):
+                                 permission_exempt_fields, reference_checks):
     # pylint: disable=too-many-arguments
     if hasattr(allowed_fields, '__call__'):
         allowed_fields = allowed_fields(request, doc.to_mongo())
@@ -109,11 +165,14 @@ def _extract_request_model_field(request, doc, input_data, field, allowed_fields
 
     val = input_data[field.name]
 
+    field_reference_checks = []
     try:
-        val = _process_value(request, field, val, allowed_fields, permission_exempt_fields)
+        val = _process_value(request, field, val, allowed_fields, permission_exempt_fields,
+                             field_reference_checks)
     except ValidationError as e:
         errors[field.name] = e.errors
         return
+    reference_checks.extend(check._replace(path=(field.name,) + check.path) for check in field_reference_checks)
 
     if hasattr(field, 'validator') and val is not None:
         try:
@@ -133,13 +192,13 @@ def _extract_request_model_field(request, doc, input_data, field, allowed_fields
     setattr(doc, field.name, val)
 
 def _extract_request_model_recursive(model_class, request, input_data, allowed_fields, errors,
-                                     changed_fields, permission_exempt_fields, existing=None):
+                                     changed_fields, permission_exempt_fields, reference_checks, existing=None):
     # pylint: disable=too-many-arguments
     doc = existing or model_class()
     if input_data:
         for name, field in model_class._fields.iteritems():
             _extract_request_model_field(request, doc, input_data, field, allowed_fields, errors, changed_fields,
-                                         permission_exempt_fields)
+                                         permission_exempt_fields, reference_checks)
 
     doc.last_updated = now()
 
@@ -161,6 +220,110 @@ def _extract_request_model_recursive(model_class, request, input_data, allowed_f
 Filter = namedtuple('Filter', 'field type_cast preserve_case')
 Filter.__new__.__defaults__ = (None, False)
 
+def _get_skip(request):
+    if not request.GET.get('skip'):
+        return 0
+    try:
+        return int(request.GET['skip'])
+    except (TypeError, ValueError):
+        raise ApiException('skip must be an integer', 400)
+
+def _get_limit(request):
+    if not request.GET.get('cnt'):
+        return DEFAULT_LIMIT
+    try:
+        return int(request.GET.get('cnt')) or DEFAULT_LIMIT
+    except (TypeError, ValueError):
+        raise ApiException('cnt must be an integer', 400)
+
+def _resolve_path(doc, path):
+    for segment in path.split('.'):
+        if not isinstance(doc, dict):
+            return None
+        doc = doc.get(segment)
+    return doc
+
+def _chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+def _ndjson(chunks):
+    dumps = get_dumps()
+    for chunk in chunks:
+        yield ''.join(dumps(obj) + '\n' for obj in chunk)
+
+def _json_array(chunks):
+    dumps = get_dumps()
+    yield '['
+    separator = ''
+    for chunk in chunks:
+        yield separator + ','.join(dumps(obj) for obj in chunk)
+        separator = ','
+    yield ']'
+
+def _etag(values, weak=False):
+    etag = '"%s"' % hashlib.sha1(repr(values)).hexdigest()
+    return 'W/' + etag if weak else etag
+
+def _last_modified(doc):
+    '''last_updated in seconds since the epoch, or None'''
+    last_updated = doc.get('last_updated')
+    return calendar.timegm(last_updated.utctimetuple()) if last_updated else None
+
+def _etag_matches(etag, if_none_match):
+    '''Weak comparison, which is what If-None-Match uses'''
+    if if_none_match.strip() == '*':
+        return True
+    opaque = lambda tag: tag.strip()[2:] if tag.strip().startswith('W/') else tag.strip()
+    return opaque(etag) in [opaque(tag) for tag in if_none_match.split(',')]
+
+def _is_conditional(request):
+    return 'HTTP_IF_NONE_MATCH' in request.META or 'HTTP_IF_MODIFIED_SINCE' in request.META
+
+def _not_modified(request, etag, last_modified):
+    '''Whether the copy the client has, according to If-None-Match or If-Modified-Since, is current'''
+    if request.method not in ('GET', 'HEAD'):
+        return False
+
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        return etag is not None and _etag_matches(etag, if_none_match)
+
+    if_modified_since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+    return bool(if_modified_since and last_modified is not None and last_modified <= if_modified_since)
+
+def _with_validators(response, etag, last_modified):
+    if etag:
+        response['ETag'] = etag
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified)
+    return response
+
+# What sort values may be in an after token. Anything else, like {"$ne": ...}, would become part of the query
+_KEYSET_VALUE_TYPES = (ObjectId, datetime, bool, float, type(None)) + integer_types + string_types
+
+def _keyset_query(sort, values):
+    '''Matches documents that come strictly after values in the given sort order.
+    i.e. for sort [(a, 1), (_id, 1)]: a > values[0] or (a == values[0] and _id > values[1])
+
+    Missing and null values sort before everything else, but $gt and $lt never match them, nor match anything
+    when given null. So after a null comes every non-null value when ascending, and nulls come after any value
+    when descending.'''
+    clauses = []
+    for i, (field, direction) in enumerate(sort):
+        equal = {prev_field: values[j] for j, (prev_field, _) in enumerate(sort[:i])}
+        if values[i] is not None:
+            clauses.append(dict(equal, **{field: {'$gt' if direction == 1 else '$lt': values[i]}}))
+            if direction == -1:
+                clauses.append(dict(equal, **{field: None}))
+        elif direction == 1:
+            clauses.append(dict(equal, **{field: {'$ne': None}}))
+    return {'$or': clauses}
+
 class ModelView(ApiView):
     duplicate_key_ok = True
     audit = True
@@ -170,15 +333,84 @@ class ModelView(ApiView):
     permission_exempt_fields = ()
 
     real_delete = False  # Whether to really delete documents or to only mark them as deleted
+
+    '''Fetch only the fields that serialize reads (see serialize.get_projection). Disable if you override
+    get methods and need whole documents.'''
+    projection_pushdown = True
     filters = {}  # hash of Filters to be used with list api
     sortable_fields = []
 
+    '''How the list api pages through results. PAGINATION_SKIP uses skip/cnt. PAGINATION_KEYSET uses cnt and
+    returns an opaque "next" token which the client passes back as "after" to get the following page.
+    Keyset pagination turns every page into a range query on the sort key and _id, so deep pages are as fast
+    as the first one. Sort fields should exist on every document.'''
+    pagination = 'skip'
+
+    '''How the list api computes num_matches. Clients can override it with the "count" query param.
+    COUNT_EXACT counts every match. COUNT_CAPPED stops counting after count_cap matches and reports "<count_cap>+".
+    COUNT_ESTIMATED reads the collection size from metadata when the query has no filter and no permission scope,
+    and real_delete is on so that the collection holds no deleted documents. Otherwise it falls back to
+    COUNT_CAPPED. COUNT_OFF skips counting and returns null.'''
+    count_mode = 'exact'
+    count_cap = 1000
+    count_cache_seconds = 0  # Cache exact counts for this long. Keyed by query, including permissions
+
+    '''How the list api queries mongo. LIST_FIND sends a count and then a find. LIST_FACET gets the page and the
+    count in one round trip with a $facet aggregation. The page must then fit in a single 16MB document.'''
+    list_strategy = 'find'
+
+    '''Cache get_list responses for this long. Keys are built from the query including the permission scope,
+    the query params (sort, pagination, fields...) and the versions of the model and of the models that
+    serialization dereferences, so a cached response is never served after a write through BaseModel. Those
+    models must be versioned, see django_mongo_rest.versions. Responses must not depend on who asks, other
+    than through allowed_find_query.'''
+    response_cache_seconds = 0
+
     SORTABLE_ALL = 'sortable_all'
+    PAGINATION_SKIP = 'skip'
+    PAGINATION_KEYSET = 'keyset'
+    COUNT_EXACT = 'exact'
+    COUNT_CAPPED = 'capped'
+    COUNT_ESTIMATED = 'estimated'
+    COUNT_OFF = 'off'
+    COUNT_MODES = (COUNT_EXACT, COUNT_CAPPED, COUNT_ESTIMATED, COUNT_OFF)
+    LIST_FIND = 'find'
+    LIST_FACET = 'facet'
+
+    allow_bulk = False  # Accept json arrays to create many objects in one request
+    idempotent_create = False  # Honor the Idempotency-Key header on POST. See django_mongo_rest.idempotency
+    max_bulk_size = 1000
+
+    '''Let clients stream every match of a list query with ?format=ndjson (one object per line) or
+    ?format=json_stream (one json array) instead of getting a page. Documents are fetched, serialized and
+    written stream_batch_size at a time, so memory use doesn't depend on the number of matches.'''
+    allow_streaming = False
+    stream_batch_size = 500
+
+    FORMAT_NDJSON = 'ndjson'
+    FORMAT_JSON_STREAM = 'json_stream'
+
+    '''Update a single object with one find_one_and_update, without loading it first. The last_updated check
+    and the permission filter are part of the update's query, and the response is {"object": <updated object>}.
+    Validation only sees the fields in the request, so editable_fields can't be callable and fields with
+    less_than_equal_to can't be involved.'''
+    atomic_update = False
+
+    '''Send ETag and Last-Modified, built from last_updated, and answer If-None-Match and If-Modified-Since
+    with 304. get_by_id checks them by fetching only _id and last_updated first. Lists get a weak ETag from
+    the ids and last_updated of the page.
+
+    Validators only cover the document's own last_updated. Changes to dereferenced foreign documents (such as
+    created_by) or to serialize_preprocess output don't change them, and clients keep their stale copy. Only
+    turn this on when the response depends on nothing but the document itself.'''
+    conditional_get = False
 
     def auto_populate_new_model(self, request, obj):
         raise NotImplementedError()
 
     def post_process_model(self, request, obj):
+        '''Called with the mongo document extracted from the request. On update, the top level fields that are
+        changed here, including nested values, are saved along with the fields the request changed.'''
         raise NotImplementedError()
 
     def __init__(self):
@@ -234,9 +466,31 @@ class ModelView(ApiView):
             raise ImproperlyConfigured('self.initial_fields not defined ' +
                                        '(the fields a user has permission to set when creating a model)')
 
+        if self.list_strategy not in (self.LIST_FIND, self.LIST_FACET):
+            raise ImproperlyConfigured('Unknown list_strategy: %s' % self.list_strategy)
+
         self._verify_allowed_fields_config('initial_fields')
         self._verify_allowed_fields_config('editable_fields')
 
+        if self.atomic_update:
+            self._verify_atomic_update_config()
+
+        if self.response_cache_seconds:
+            models = {self.model} | get_foreign_models(self.model)
+            unversioned = sorted(model.__name__ for model in models if not versions.is_versioned(model))
+            if unversioned:
+                raise ImproperlyConfigured('response_cache_seconds needs versioned models ' +
+                                           '(meta = {\'versioned\': True}): %s' % ', '.join(unversioned))
+
+    def _verify_atomic_update_config(self):
+        if hasattr(self.editable_fields, '__call__'):
+            raise ImproperlyConfigured('atomic_update needs editable_fields that are not callable')
+
+        for name, field in self.model._fields.iteritems():
+            greater_field = getattr(field, 'less_than_equal_to', None)
+            if greater_field and (name in self.editable_fields or greater_field in self.editable_fields):
+                raise ImproperlyConfigured('atomic_update can\'t check %s <= %s' % (name, greater_field))
+
     def get(self, request, obj_id, **kwargs):
         if obj_id:
             return self.get_by_id(request, obj_id)
@@ -245,27 +499,96 @@ class ModelView(ApiView):
         else:
             return self.get_list(request, **kwargs)
 
+    def _serialize_fields_map(self):
+        '''Maps the names clients see to the serialize_fields of the model'''
+        fields_map = {}
+        for f in self.model.serialize_fields:
+            if isinstance(f, tuple):
+                fields_map[f[1]] = f[0]
+            elif f == '_id':
+                fields_map['id'] = f
+            else:
+                fields_map[f] = f
+        return fields_map
+
+    def _include_fields(self, request):
+        '''The serialize_fields the client asked for with ?fields=a,b. None means all of them'''
+        if not request.GET.get('fields'):
+            return None
+
+        fields_map = self._serialize_fields_map()
+        requested = set()
+        for field in request.GET['fields'].split(','):
+            field = field.strip()
+            if not field:
+                continue
+            if field not in fields_map:
+                raise ApiException('Unknown field: %s. Allowed are %s' % (field, sorted(fields_map.keys())), 400)
+            requested.add(fields_map[field])
+
+        # Without duplicates and in serialize_fields order, so equivalent requests share cached plans and projections
+        include_fields = [f[0] if isinstance(f, tuple) else f for f in self.model.serialize_fields]
+        return [f for f in include_fields if f in requested] or None
+
+    def _find_params(self, request, list_read=False, **kwargs):
+        read_preference = self.read_preference if list_read else None
+        return FindParams(request=request, read_preference=read_preference, max_time_ms=self.max_time_ms,
+                          **kwargs)
+
+    def _update_params(self, request, **kwargs):
+        return UpdateParams(request=None if request.user.is_superuser else request,
+                            write_concern=self.write_concern, **kwargs)
+
+    def _projection(self, include_fields=None, extra_paths=()):
+        if not self.projection_pushdown:
+            return None
+        # last_updated is always fetched for conditional_get
+        return get_projection(self.model, include_fields=include_fields,
+                              extra_paths=tuple(extra_paths) + ('last_updated',))
+
+    @staticmethod
+    def _validators(obj, include_fields):
+        '''Returns (etag, last_modified), which are None when obj has no last_updated'''
+        last_modified = _last_modified(obj)
+        if last_modified is None:
+            return None, None
+        return _etag((obj['_id'], obj['last_updated'], include_fields)), last_modified
+
     def get_by_id(self, request, obj_id):
+        include_fields = self._include_fields(request)
         query = {'_id': obj_id}
         self._filter(request, query, {})
-        obj = get_object_or_404(self.model, request, query)
-        serialized = serialize(self.model, obj, request)
-        return {'object': serialized}
+        if self.conditional_get and _is_conditional(request):
+            probe = get_object_or_404(self.model, request, query, projection={'_id': 1, 'last_updated': 1},
+                                      max_time_ms=self.max_time_ms)
+            etag, last_modified = self._validators(probe, include_fields)
+            if _not_modified(request, etag, last_modified):
+                return _with_validators(HttpResponseNotModified(), etag, last_modified)
+
+        obj = get_object_or_404(self.model, request, query, projection=self._projection(include_fields),
+                                max_time_ms=self.max_time_ms)
+        serialized = serialize(self.model, obj, request, include_fields=include_fields)
+        res = {'object': serialized}
+        if not self.conditional_get:
+            return res
+        return _with_validators(json_response(res), *self._validators(obj, include_fields))
 
     def get_by_ids(self, request, ids):
+        include_fields = self._include_fields(request)
         query = {'_id': {'$in': ids}}
         self._filter(request, query, {})
-        params = FindParams(request=None if request.user.is_superuser else request)
+        params = self._find_params(None if request.user.is_superuser else request,
+                                   projection=self._projection(include_fields))
         try:
             objs = list(self.model.find(params=params, **query))
         except ModelPermissionException:
             raise ApiException(self.model.msg404(), 404)
 
-        if len(objs != len(ids)):
+        if len(objs) != len(ids):
             found_ids = {str(obj['_id']) for obj in objs}
             missing_ids = [i for i in ids if i not in found_ids]
             raise ApiException(', '.join(missing_ids) + ' not found', 404)
-        serialized = serialize(self.model, objs, request)
+        serialized = serialize(self.model, objs, request, include_fields=include_fields)
         return {'objects': serialized}
 
     def _filter(self, request, query, view_kwargs):
@@ -300,39 +623,28 @@ class ModelView(ApiView):
 
     @staticmethod
     def _paginate(request, cursor):
-        if request.GET.get('skip'):
-            try:
-                cursor.skip(int(request.GET['skip']))
-            except (TypeError, ValueError):
-                raise ApiException('skip must be an integer', 400)
+        skip = _get_skip(request)
+        if skip:
+            cursor.skip(skip)
 
-        DEFAULT_LIMIT = 10
-        if request.GET.get('cnt'):
-            try:
-                cursor.limit(int(request.GET.get('cnt')) or DEFAULT_LIMIT)
-            except (TypeError, ValueError):
-                raise ApiException('cnt must be an integer', 400)
-        else:
-            cursor.limit(DEFAULT_LIMIT)
+        cursor.limit(_get_limit(request))
 
     def _sort(self, request, cursor):
+        sort = self._get_sort(request)
+        if sort:
+            cursor.sort(*sort)
+
+    def _get_sort(self, request):
+        '''Returns the (field, direction) the client asked to sort by, or None'''
         if not request.GET.get('sort'):
-            return
+            return None
 
         sort_field = request.GET.get('sort')
         if (self.sortable_fields != self.SORTABLE_ALL and sort_field not in self.sortable_fields):
             raise ApiException('Unknown sort field: %s. Allowed are %s' %
                                (sort_field, self.sortable_fields), 400)
 
-        fields_map = {}
-        for f in self.model.serialize_fields:
-            if isinstance (f, tuple):
-                fields_map[f[1]] = f[0]
-            elif f == '_id':
-                fields_map['id'] = f
-            else:
-                fields_map[f] = f
-
+        fields_map = self._serialize_fields_map()
         if sort_field not in fields_map:
             raise ApiException('Unknown sort field: %s. Allowed are %s' %
                                (sort_field, self.sortable_fields), 400)
@@ -344,10 +656,182 @@ class ModelView(ApiView):
         if direction not in [1, -1]:
             raise ApiException('sortDir must be either 1 or -1', 400)
 
-        cursor.sort(fields_map[sort_field], direction=direction)
+        return fields_map[sort_field], direction
+
+    def _keyset_sort(self, request):
+        '''_id is always the last sort key, so that the sort order is total and a page boundary is unambiguous'''
+        sort = self._get_sort(request)
+        if not sort:
+            return [('_id', 1)]
+        if sort[0] == '_id':
+            return [sort]
+        return [sort, ('_id', sort[1])]
+
+    def _keyset_after(self, request, sort):
+        '''Returns a query matching the documents after the client's "after" token, or None for the first page'''
+        if request.GET.get('skip'):
+            raise ApiException('skip is not supported by this api. Use after instead', 400)
+
+        if not request.GET.get('after'):
+            return None
+
+        try:
+            token_sort, values = decode_cursor(request.GET['after'])
+        except ValueError:
+            raise ApiException('Invalid after token', 400)
+        if (not isinstance(values, list) or len(values) != len(sort) or
+                not all(isinstance(value, _KEYSET_VALUE_TYPES) for value in values)):
+            raise ApiException('Invalid after token', 400)
+        if token_sort != sort:
+            raise ApiException('after token does not match the requested sort', 400)
+
+        return _keyset_query(sort, values)
+
+    @staticmethod
+    def _keyset_next(objs, sort, limit):
+        '''objs was fetched with limit + 1 to find out whether there is a next page. Returns (objs, next_token)'''
+        if len(objs) <= limit:
+            return objs, None
+
+        objs = objs[:limit]
+        return objs, encode_cursor(sort, [_resolve_path(objs[-1], field) for field, _ in sort])
+
+    def _keyset_page(self, request, query, include_fields=None):
+        '''Returns (objs, next_token)'''
+        sort = self._keyset_sort(request)
+        after = self._keyset_after(request, sort)
+        if after:
+            query = dict(query)
+            query['$and'] = query.get('$and', []) + [after]
+
+        limit = _get_limit(request)
+        params = self._find_params(request, list_read=True, sort=sort, limit=limit + 1,
+                                   projection=self._projection(include_fields, [field for field, _ in sort]))
+        objs = list(self.model.find(params=params, **query))
+        return self._keyset_next(objs, sort, limit)
+
+    def _count_mode(self, request, query):
+        mode = request.GET.get('count') or self.count_mode
+        if mode not in self.COUNT_MODES:
+            raise ApiException('count must be one of %s' % str(self.COUNT_MODES), 400)
+
+        # The estimate includes documents that are only marked as deleted
+        if mode == self.COUNT_ESTIMATED and (query or not request.user.is_superuser or not self.real_delete):
+            return self.COUNT_CAPPED
+        return mode
+
+    def _count_cache_key(self, request, query):
+        if not self.count_cache_seconds:
+            return None
+        lookup_query = self.model._get_lookup_query_find(dict(query), request=request)
+        return 'dmr:count:%s:%s' % (self.model.get_collection_name(), query_hash(lookup_query))
+
+    def _capped(self, num_matches):
+        if num_matches > self.count_cap:
+            return '%d+' % self.count_cap
+        return num_matches
+
+    def _count(self, request, query):
+        mode = self._count_mode(request, query)
+        if mode == self.COUNT_OFF:
+            return None
+        params = self._find_params(request, list_read=True)
+        if mode == self.COUNT_ESTIMATED:
+            return self.model.estimated_count(params=params)
+        if mode == self.COUNT_CAPPED:
+            return self._capped(self.model.count(request=request, limit=self.count_cap + 1, params=params,
+                                                 **query))
+
+        key = self._count_cache_key(request, query)
+        num_matches = cache.get(key) if key else None
+        if num_matches is None:
+            num_matches = self.model.count(request=request, params=params, **query)
+            if key:
+                cache.set(key, num_matches, self.count_cache_seconds)
+        return num_matches
+
+    def _facet_list(self, request, query, include_fields=None):
+        '''Fetches the page and num_matches with a single aggregation. Returns (objs, num_matches, next_token)'''
+        limit = _get_limit(request)
+        keyset = self.pagination == self.PAGINATION_KEYSET
+        page = []
+        if keyset:
+            sort = self._keyset_sort(request)
+            after = self._keyset_after(request, sort)
+            if after:
+                page.append({'$match': after})
+            page.append({'$sort': SON(sort)})
+            page.append({'$limit': limit + 1})
+            projection = self._projection(include_fields, [field for field, _ in sort])
+        else:
+            sort = self._get_sort(request)
+            if sort:
+                page.append({'$sort': SON([sort])})
+            skip = _get_skip(request)
+            if skip:
+                page.append({'$skip': skip})
+            page.append({'$limit': limit})
+            projection = self._projection(include_fields)
+        if projection:
+            page.append({'$project': projection})
+        facets = {'objects': page}
+
+        mode = self._count_mode(request, query)
+        num_matches = None
+        cache_key = None
+        if mode == self.COUNT_EXACT:
+            cache_key = self._count_cache_key(request, query)
+            num_matches = cache.get(cache_key) if cache_key else None
+            if num_matches is None:
+                facets['num_matches'] = [{'$count': 'n'}]
+        elif mode == self.COUNT_CAPPED:
+            facets['num_matches'] = [{'$limit': self.count_cap + 1}, {'$count': 'n'}]
+        params = self._find_params(request, list_read=True)
+        if mode == self.COUNT_ESTIMATED:
+            num_matches = self.model.estimated_count(params=params)
+
+        lookup_query = self.model._get_lookup_query_find(dict(query), request=request)
+        res = next(self.model.aggregate([{'$match': lookup_query}, {'$facet': facets}], params=params))
+
+        if 'num_matches' in facets:
+            num_matches = res['num_matches'][0]['n'] if res['num_matches'] else 0
+            if mode == self.COUNT_CAPPED:
+                num_matches = self._capped(num_matches)
+            elif cache_key:
+                cache.set(cache_key, num_matches, self.count_cache_seconds)
+
+        objs = res['objects']
+        next_token = None
+        if keyset:
+            objs, next_token = self._keyset_next(objs, sort, limit)
+        return objs, num_matches, next_token
+
+    def _serialized_chunks(self, request, cursor, include_fields):
+        for chunk in _chunks(cursor, self.stream_batch_size):
+            # Foreign keys are prefetched once per chunk
+            yield serialize(self.model, chunk, request, include_fields=include_fields)
+
+    def stream_list(self, request, query, response_format, include_fields=None):
+        '''Streams every match of query, ignoring pagination'''
+        if not self.allow_streaming or response_format not in (self.FORMAT_NDJSON, self.FORMAT_JSON_STREAM):
+            raise ApiException('Unsupported format: %s' % response_format, 400)
+
+        sort = self._get_sort(request)
+        params = self._find_params(request, list_read=True, projection=self._projection(include_fields),
+                                   sort=[sort] if sort else None, batch_size=self.stream_batch_size)
+        try:
+            cursor = self.model.find(params=params, **query)
+        except ModelPermissionException:
+            cursor = []
+
+        chunks = self._serialized_chunks(request, cursor, include_fields)
+        if response_format == self.FORMAT_NDJSON:
+            return StreamingHttpResponse(_ndjson(chunks), content_type='application/x-ndjson')
+        return StreamingHttpResponse(_json_array(chunks), content_type='application/json')
 
     def get_list(self, request, **kwargs):
-        params = FindParams(request=request)
+        include_fields = self._include_fields(request)
+        params = self._find_params(request, list_read=True, projection=self._projection(include_fields))
 
         query = {}
         if request.GET.get('mine'):
@@ -355,27 +839,89 @@ class ModelView(ApiView):
 
         self._filter(request, query, kwargs)
 
+        if request.GET.get('format'):
+            return self.stream_list(request, query, request.GET['format'], include_fields)
+
+        cache_key = self._response_cache_key(request, query, include_fields)
+        cached = cache.get(cache_key) if cache_key else None
+        res = None
+        if cached:
+            res, etag = cached
+        else:
+            objs, num_matches, next_token = self._list_page(request, query, include_fields, params)
+            etag = None
+            if self.conditional_get and all(obj.get('last_updated') for obj in objs):
+                etag = _etag(([(obj['_id'], obj['last_updated']) for obj in objs], num_matches, next_token,
+                              include_fields), weak=True)
+
+        if etag and _not_modified(request, etag, None):
+            return _with_validators(HttpResponseNotModified(), etag, None)
+
+        if res is None:
+            res = {'objects': serialize(self.model, objs, request, include_fields=include_fields),
+                   'num_matches': num_matches}
+            if self.pagination == self.PAGINATION_KEYSET:
+                res['next'] = next_token
+            if cache_key:
+                cache.set(cache_key, (res, etag), self.response_cache_seconds)
+
+        if not etag:
+            return res
+        return _with_validators(json_response(res), etag, None)
+
+    def _list_page(self, request, query, include_fields, params):
+        '''Returns (objs, num_matches, next_token)'''
+        next_token = None
         try:
-            cursor = self.model.find(params=params, **query)
+            if self.list_strategy == self.LIST_FACET:
+                return self._facet_list(request, query, include_fields)
+
+            num_matches = self._count(request, query)
+            if self.pagination == self.PAGINATION_KEYSET:
+                objs, next_token = self._keyset_page(request, query, include_fields)
+            else:
+                cursor = self.model.find(params=params, **query)
+                self._paginate(request, cursor)
+                self._sort(request, cursor)
+                objs = list(cursor)
         except ModelPermissionException:
             num_matches = 0
             objs = []
-        else:
-            num_matches = cursor.count()
-            self._paginate(request, cursor)
-            self._sort(request, cursor)
-            objs = list(cursor)
+        return objs, num_matches, next_token
 
-        serialized = serialize(self.model, objs, request)
-        return {'objects': serialized,
-                'num_matches': num_matches}
+    def _response_cache_key(self, request, query, include_fields):
+        '''None when this get_list response can't be cached'''
+        if not self.response_cache_seconds:
+            return None
+        models = {self.model} | get_foreign_models(self.model, include_fields=include_fields)
+        if not all(versions.is_versioned(model) for model in models):
+            # include_fields reaches a model that isn't versioned
+            return None
 
-    def extract_request_model(self, request, input_data, allowed_fields, existing=None):
+        try:
+            lookup_query = self.model._get_lookup_query_find(dict(query), request=request)
+        except ModelPermissionException:
+            lookup_query = None
+        model_versions = sorted((model.get_collection_name(), version)
+                                for model, version in versions.get_versions(models).iteritems())
+        key = {'query': lookup_query, 'params': sorted(request.GET.lists()), 'versions': model_versions}
+        return 'dmr:list:%s:%s' % (self.model.get_collection_name(), query_hash(key))
+
+    def extract_request_model(self, request, input_data, allowed_fields, existing=None, partial=False):
+        '''partial is for updates that don't load the existing document. Every allowed field in input_data
+        counts as changed, and errors about other fields, such as missing required ones, are ignored.'''
         errors = {}
         changed_fields = []
+        reference_checks = []
         doc = _extract_request_model_recursive(self.model, request, input_data, allowed_fields,
                                                errors, changed_fields, self.permission_exempt_fields,
-                                               existing=existing)
+                                               reference_checks, existing=existing)
+        _check_references(reference_checks, errors)
+
+        if partial:
+            errors = {field: error for field, error in errors.iteritems() if field in input_data}
+            changed_fields = [field for field in self.model._fields
+                              if field in input_data and field in allowed_fields]
 
         if errors:
             raise ValidationError('Validation Error', errors=errors)
@@ -385,51 +931,76 @@ class ModelView(ApiView):
         remove_empty_lists(doc)
 
         request.model_view_changed_fields = changed_fields
+        # To find the fields post_process_model changes, even in place
+        before_post_process = deepcopy(doc)
         try:
             self.post_process_model(request, doc)
         except NotImplementedError:
-            pass
+            request.model_view_post_processed_fields = []
+        else:
+            request.model_view_post_processed_fields = [
+                field for field in set(before_post_process) | set(doc)
+                if field not in doc or field not in before_post_process or doc[field] != before_post_process[field]]
 
         return doc
 
-    def _prune_uneditable_fields(self, doc, allowed_fields):
-        for field in doc:
-            if field not in allowed_fields:
-                del doc[field]
-            elif isinstance(doc[field], dict):
-                self._prune_uneditable_fields(doc[field], allowed_fields[field])
+    @staticmethod
+    def _audit_updates(doc, action, allowed_fields, changed_fields):
+        '''The changes to record in the audit log, or None if there is nothing to record.
+        Only the changed fields are copied, and only as deep as needed to leave out uneditable fields.'''
+        updates = {}
+        if action == audit.ACTIONS.DELETE:
+            return updates
+
+        if not changed_fields and action == audit.ACTIONS.UPDATE:
+            # Nothing was actually updated
+            return None
+
+        # Leave out fields which user didn't actually edit, like _id, from embedded documents
+        for field in changed_fields:
+            value = doc.get(field)
+            if isinstance(value, dict):
+                value = _editable_subset(value, allowed_fields[field])
+            elif isinstance(value, list) and len(value) and isinstance(value[0], dict):
+                value = [_editable_subset(embedded, allowed_fields[field]) for embedded in value]
+            updates[field] = value
+
+        return updates
 
     def _create_audit_log(self, request, doc, action, allowed_fields):
         if not self.audit:
             return
 
-        updates = {}
-        if action != audit.ACTIONS.DELETE:
-            if not request.model_view_changed_fields and action == audit.ACTIONS.UPDATE:
-                # Nothing was actually updated
-                return
-
-            # Remove fields which user didn't actually edit, like _id, from embedded documents
-            doc = deepcopy(doc)
-            for field in request.model_view_changed_fields:
-                if field not in doc:
-                    updates[field] = None
-                    continue
+        changed_fields = () if action == audit.ACTIONS.DELETE else request.model_view_changed_fields
+        updates = self._audit_updates(doc, action, allowed_fields, changed_fields)
+        if updates is not None:
+            audit.create(request, action, self.model, doc, updates)
 
-                if isinstance(doc[field], dict):
-                    self._prune_uneditable_fields(doc[field], allowed_fields[field])
-                elif isinstance(doc[field], list) and len(doc[field]) and isinstance(doc[field][0], dict):
-                    for embedded in doc[field]:
-                        self._prune_uneditable_fields(embedded, allowed_fields[field])
-
-                updates[field] = doc[field]
+    def _create_audit_logs(self, request, docs, action, allowed_fields):
+        '''Audit many documents with a single insert. docs is a list of (doc, changed_fields)'''
+        if not self.audit:
+            return
 
-        audit.create(request, action, self.model, doc, updates)
+        audited = []
+        for doc, changed_fields in docs:
+            updates = self._audit_updates(doc, action, allowed_fields, changed_fields)
+            if updates is not None:
+                audited.append((doc, updates))
+        audit.create_many(request, action, self.model, audited)
 
     def create(self, request, obj_id):
         if obj_id:
             raise Http404()
 
+        key = idempotency.get_key(request) if self.idempotent_create else None
+        if key:
+            return idempotency.run(request, self.model.get_collection_name(), key, lambda: self._create(request))
+        return self._create(request)
+
+    def _create(self, request):
+        if isinstance(request.dmr_params, list):
+            return self.bulk_create(request, request.dmr_params)
+
         try:
             obj = self.extract_request_model(request, request.dmr_params, self.initial_fields)
         except ValidationError as e:
@@ -441,7 +1012,7 @@ class ModelView(ApiView):
             pass
 
         try:
-            self.model.insert_one(obj)
+            self.model.insert_one(obj, write_concern=self.write_concern)
         except DuplicateKeyError as e:
             '''Usually this means a duplicate request (user pressed button twice or browser sent request
             twice) and we want to ignore it.'''
@@ -456,10 +1027,105 @@ class ModelView(ApiView):
 
         return {'id': str(obj['_id'])}
 
+    def _check_bulk_size(self, items):
+        if not self.allow_bulk:
+            raise ApiException('Expected a json object', 400)
+        if len(items) > self.max_bulk_size:
+            raise ApiException('At most %d objects are allowed per request' % self.max_bulk_size, 400)
+
+    def bulk_create(self, request, items):
+        '''Creates every valid item with a single insert_many.
+
+        Returns a result per item, in the same order: {"id": ...} when created, {"id": ..., "duplicate": true}
+        when it already existed and duplicate_key_ok, or {"errors": ...}.'''
+        self._check_bulk_size(items)
+
+        results = [None] * len(items)
+        valid = []  # (index, obj, changed_fields)
+        for i, item in enumerate(items):
+            if not isinstance(item, dict):
+                results[i] = {'errors': 'Expected a json object'}
+                continue
+
+            try:
+                obj = self.extract_request_model(request, item, self.initial_fields)
+            except ValidationError as e:
+                results[i] = {'errors': e.to_dict()}
+                continue
+
+            try:
+                self.auto_populate_new_model(request, obj)
+            except NotImplementedError:
+                pass
+
+            valid.append((i, obj, request.model_view_changed_fields))
+
+        write_errors = {}
+        if valid:
+            try:
+                self.model.insert_many([obj for _, obj, _ in valid], ordered=False,
+                                       write_concern=self.write_concern)
+            except BulkWriteError as e:
+                write_errors = {error['index']: error for error in e.details['writeErrors']}
+
+        created = []
+        for position, (i, obj, changed_fields) in enumerate(valid):
+            error = write_errors.get(position)
+            if not error:
+                results[i] = {'id': str(obj['_id'])}
+                created.append((obj, changed_fields))
+            elif error['code'] not in DUPLICATE_KEY_ERROR_CODES:
+                results[i] = {'errors': error['errmsg']}
+            else:
+                duplicate = self.duplicate_key_ok and _get_duplicate_model(self.model, obj)
+                if duplicate:
+                    results[i] = {'id': str(duplicate['_id']), 'duplicate': True}
+                else:
+                    results[i] = {'errors': 'Duplicate object', 'error_code': 'DUP'}
+
+        self._create_audit_logs(request, created, audit.ACTIONS.CREATE, self.initial_fields)
+        return {'objects': results}
+
+    def _to_model_id(self, obj_id):
+        if isinstance(self.model.id, ObjectIdField):
+            return ObjectId(obj_id)
+        return obj_id
+
+    def _unset_fields(self, input_data):
+        unset = []
+        for field_name, field in self.model._fields.iteritems():
+            val = input_data.get(field_name, True)
+            if val is None or val == []:
+                unset.append(field_name)
+        return unset
+
+    def _changed_fields(self, request, obj, input_data):
+        '''Returns ($set, $unset) for an update, holding only what the request or post_process_model changed.
+        Untouched fields, like large embedded lists, aren't rewritten.'''
+        fields = self.model._fields
+        changed = [fields[name].db_field for name in request.model_view_changed_fields]
+        changed += request.model_view_post_processed_fields
+
+        changes = {'last_updated': obj['last_updated']}
+        unset = self._unset_fields(input_data)
+        for field in changed:
+            if field == '_id':
+                continue
+            if field in obj:
+                changes[field] = obj[field]
+            elif field not in unset:
+                unset.append(field)
+        return changes, unset
+
     def update(self, request, obj_id):
         if not obj_id:
+            if isinstance(request.dmr_params, list):
+                return self.bulk_update(request, request.dmr_params)
             raise Http404()
 
+        if self.atomic_update:
+            return self.update_atomic(request, obj_id)
+
         existing_model = get_orm_object_or_404_by_id(self.model, request, obj_id)
         self._refuse_conflicting_update(request.dmr_params, request, existing_model)
 
@@ -469,31 +1135,200 @@ class ModelView(ApiView):
         except ValidationError as e:
             raise ApiException(e.to_dict(), 400)
 
-        unset = []
-        for field_name, field in self.model._fields.iteritems():
-            val = request.dmr_params.get(field_name, True)
-            if val is None or val == []:
-                unset.append(field_name)
-
-        update_params = UpdateParams(request=None if request.user.is_superuser else request, unset=unset)
+        changes, unset = self._changed_fields(request, obj, request.dmr_params)
+        update_params = self._update_params(request, unset=unset)
 
         try:
-            del obj['_id'] # Don't try to update this
-            res = self.model.update_by_id(obj_id, update_params=update_params, **obj)
+            res = self.model.update_by_id(obj_id, update_params=update_params, **changes)
         except ModelPermissionException:
             raise ApiException(self.model.msg404(), 400)
         except DuplicateKeyError:
             raise ApiException('Duplicate object', 400, 'DUP')
         else:
-            if isinstance(self.model.id, ObjectIdField):
-                obj['_id'] = ObjectId(obj_id)
-            else:
-                obj['_id'] = obj_id
-            self._create_audit_log(request, obj, audit.ACTIONS.UPDATE, self.editable_fields)
+            changes['_id'] = self._to_model_id(obj_id)
+            self._create_audit_log(request, changes, audit.ACTIONS.UPDATE, self.editable_fields)
 
         if not res.matched_count:
             raise ApiException(self.model.msg404(), 404)
 
+    def update_atomic(self, request, obj_id):
+        '''See atomic_update'''
+        try:
+            obj = self.extract_request_model(request, request.dmr_params, self.editable_fields, partial=True)
+        except ValidationError as e:
+            raise ApiException(e.to_dict(), 400)
+
+        changes, unset = self._changed_fields(request, obj, request.dmr_params)
+        update_params = self._update_params(request, unset=unset)
+
+        lookup = {'_id': obj_id}
+        request_last_updated = self._request_last_updated(request.dmr_params)
+        if request_last_updated:
+            lookup['$or'] = [{'last_updated': {'$lte': request_last_updated}}, {'last_updated': None}]
+
+        projection = self._projection()
+        try:
+            updated = self.model.find_one_and_update(lookup, changes, update_params=update_params,
+                                                     projection=projection)
+        except ModelPermissionException:
+            raise ApiException(self.model.msg404(obj_id=obj_id), 404)
+        except DuplicateKeyError:
+            raise ApiException('Duplicate object', 400, 'DUP')
+
+        if not updated:
+            # Either the precondition missed or the object doesn't exist for this user
+            current = None
+            if request_last_updated:
+                params = self._find_params(request, projection=projection, limit=1)
+                try:
+                    query = self._editable_query(request, {'_id': self._to_model_id(obj_id)})
+                    current = next(iter(self.model.find(params=params, **query)), None)
+                except (ModelPermissionException, InvalidId):
+                    pass
+            if current and current.get('last_updated', datetime(1970, 1, 1, tzinfo=pytz.utc)) > request_last_updated:
+                raise ApiException('Object is out of date', 409,
+                                   new_obj=serialize(self.model, current, request))
+            raise ApiException(self.model.msg404(obj_id=obj_id), 404)
+
+        changes['_id'] = updated['_id']
+        self._create_audit_log(request, changes, audit.ACTIONS.UPDATE, self.editable_fields)
+        return {'object': serialize(self.model, updated, request)}
+
+    def _editable_query(self, request, query):
+        '''query restricted to the documents this user may edit'''
+        if request.user.is_superuser:
+            return query
+        return {'$and': [query, self.model.allowed_update_query(request)]}
+
+    def _bulk_find_ids(self, request, ids):
+        '''Returns {id string: model id} for the ids this user may edit'''
+        model_ids = []
+        for obj_id in ids:
+            try:
+                model_ids.append(self._to_model_id(obj_id))
+            except (InvalidId, TypeError):
+                pass
+
+        query = self._editable_query(request, {'_id': {'$in': model_ids}})
+        params = self._find_params(request, projection={'_id': 1})
+        return {str(doc['_id']): doc['_id'] for doc in self.model.find(params=params, **query)}
+
+    def bulk_update(self, request, items):
+        '''Applies a list of {"id": ..., "changes": {...}} with a single bulk_write.
+
+        Returns a result per item, in the same order: {"id": ...} when updated, otherwise
+        {"id": ..., "errors": ..., "status": ...}'''
+        self._check_bulk_size(items)
+
+        results = []
+        for item in items:
+            if not isinstance(item, dict) or not item.get('id') or not isinstance(item.get('changes'), dict):
+                results.append({'id': None, 'errors': 'Expected {"id": ..., "changes": {...}}', 'status': 400})
+            else:
+                results.append({'id': str(item['id'])})
+
+        ids = [result['id'] for result in results if result['id']]
+        try:
+            existing_models = {str(model.id): model for model in
+                               self.model.get_orm_by_ids(self._bulk_find_ids(request, ids).values(),
+                                                         params=self._find_params(request))}
+        except ModelPermissionException:
+            existing_models = {}
+
+        operations = []
+        updated = []  # (result, obj, changed_fields, request_last_updated), in the same order as operations
+        for item, result in zip(items, results):
+            if 'errors' in result:
+                continue
+
+            existing_model = existing_models.get(result['id'])
+            if not existing_model:
+                result.update(errors=self.model.msg404(result['id']), status=404)
+                continue
+
+            try:
+                self._refuse_conflicting_update(item['changes'], request, existing_model)
+                obj = self.extract_request_model(request, item['changes'], self.editable_fields,
+                                                 existing=existing_model)
+            except ApiException as e:
+                result.update(errors=e.message, status=e.status_code)
+                if hasattr(e, 'new_obj'):
+                    result['new_obj'] = e.new_obj
+                continue
+            except ValidationError as e:
+                result.update(errors=e.to_dict(), status=400)
+                continue
+
+            changes, unset = self._changed_fields(request, obj, item['changes'])
+            lookup = {'_id': existing_model.id}
+            request_last_updated = self._request_last_updated(item['changes'])
+            if request_last_updated:
+                # Checked again by the write, in case the object changes in between
+                lookup['$or'] = [{'last_updated': {'$lte': request_last_updated}}, {'last_updated': None}]
+            operations.append(self.model.update_one_op(lookup, update_params=self._update_params(request, unset=unset),
+                                                       **changes))
+            changes['_id'] = existing_model.id
+            updated.append((result, changes, request.model_view_changed_fields, request_last_updated))
+
+        write_errors = {}
+        matched = len(operations)
+        if operations:
+            try:
+                res = self.model.bulk_write(operations, ordered=False, write_concern=self.write_concern)
+                matched = res.matched_count
+            except BulkWriteError as e:
+                write_errors = {error['index']: error for error in e.details['writeErrors']}
+                matched = e.details['nMatched']
+
+        for i, (result, _, _, _) in enumerate(updated):
+            error = write_errors.get(i)
+            if not error:
+                continue
+            if error['code'] in DUPLICATE_KEY_ERROR_CODES:
+                result.update(errors='Duplicate object', error_code='DUP', status=400)
+            else:
+                result.update(errors=error['errmsg'], status=400)
+
+        succeeded = [update for update in updated if 'errors' not in update[0]]
+        if matched < len(succeeded):
+            self._refuse_missed_updates(request, succeeded)
+
+        audited = [(obj, changed_fields) for result, obj, changed_fields, _ in updated if 'errors' not in result]
+        self._create_audit_logs(request, audited, audit.ACTIONS.UPDATE, self.editable_fields)
+        return {'objects': results}
+
+    def _refuse_missed_updates(self, request, updated):
+        '''Some bulk updates matched nothing, because their object was deleted, left this user's edit scope or
+        was changed since it was looked up. Marks the results of those that can't be found anymore as 404 and
+        of those that are newer than the client's last_updated as 409.'''
+        query = self._editable_query(request, {'_id': {'$in': [obj['_id'] for _, obj, _, _ in updated]}})
+        params = self._find_params(request, projection=self._projection())
+        try:
+            current = {doc['_id']: doc for doc in self.model.find(params=params, **query)}
+        except ModelPermissionException:
+            current = {}
+
+        for result, obj, _, request_last_updated in updated:
+            doc = current.get(obj['_id'])
+            if not doc:
+                result.update(errors=self.model.msg404(result['id']), status=404)
+            elif request_last_updated and doc.get('last_updated', request_last_updated) > request_last_updated:
+                result.update(errors='Object is out of date', status=409,
+                              new_obj=serialize(self.model, doc, request))
+
+    @staticmethod
+    def _request_last_updated(input_data):
+        '''The last_updated the client last saw, or None'''
+        request_last_updated = input_data.get('last_updated')
+        if not request_last_updated:
+            return None
+
+        try:
+            request_last_updated = int(request_last_updated)
+        except ValueError:
+            raise ApiException({'last_updated': 'expected integer'}, 400)
+        return datetime.utcfromtimestamp(request_last_updated).replace(tzinfo=pytz.utc)
+
     def _refuse_conflicting_update(self, input_data, request, existing_model):
         '''
         Check if user is trying to update an old version of this object
@@ -501,27 +1336,24 @@ class ModelView(ApiView):
         Useful if 2 users can update the same object from different browsers, ui can show the changes
         and ask for confirmation.
         '''
-        request_last_updated = input_data.get('last_updated')
+        request_last_updated = self._request_last_updated(input_data)
         if not request_last_updated:
             return
 
-        try:
-            request_last_updated = int(request_last_updated)
-        except ValueError:
-            raise ApiException({'last_updated': 'expected integer'}, 400)
-        request_last_updated = datetime.utcfromtimestamp(request_last_updated).replace(tzinfo=pytz.utc)
-
         existing_model = existing_model.to_mongo()
         if existing_model.get('last_updated', datetime(1970, 1, 1)) > request_last_updated:
             up_to_date_obj = serialize(self.model, existing_model, request)
             raise ApiException('Object is out of date', 409, new_obj=up_to_date_obj)
 
     def delete(self, request, obj_id):
-        update_params = UpdateParams(request=None if request.user.is_superuser else request)
+        if not obj_id and request.GET.get('ids'):
+            return self.bulk_delete(request, request.GET['ids'].split(','))
+
+        update_params = self._update_params(request)
 
         if self.real_delete:
             try:
-                res = self.model.delete_by_id(obj_id, request=request)
+                res = self.model.delete_by_id(obj_id, request=request, write_concern=self.write_concern)
             except ModelPermissionException:
                 raise ApiException(self.model.msg404(), 404)
 
@@ -536,6 +1368,65 @@ class ModelView(ApiView):
             if not res.matched_count:
                 raise ApiException(self.model.msg404(), 404)
 
-        if isinstance(self.model.id, ObjectIdField):
-            obj_id = ObjectId(obj_id)
-        self._create_audit_log(request, {'_id': obj_id}, audit.ACTIONS.DELETE, None)
+        self._create_audit_log(request, {'_id': self._to_model_id(obj_id)}, audit.ACTIONS.DELETE, None)
+
+    def bulk_delete(self, request, ids):
+        '''Deletes many ids with a single bulk_write.
+
+        Returns a result per id, in the same order: {"id": ...} when deleted, otherwise
+        {"id": ..., "errors": ..., "status": ...}'''
+        self._check_bulk_size(ids)
+
+        try:
+            model_ids = self._bulk_find_ids(request, ids)
+        except ModelPermissionException:
+            model_ids = {}
+
+        update_params = self._update_params(request)
+        results = []
+        deleting = []
+        operations = []
+        for obj_id in ids:
+            if obj_id not in model_ids:
+                results.append({'id': obj_id, 'errors': self.model.msg404(obj_id), 'status': 404})
+                continue
+
+            result = {'id': obj_id}
+            results.append(result)
+            deleting.append(result)
+            if self.real_delete:
+                operations.append(self.model.delete_one_op(request=update_params.request, _id=model_ids[obj_id]))
+            else:
+                operations.append(self.model.update_one_op({'_id': model_ids[obj_id]}, update_params=update_params,
+                                                           deleted=True))
+
+        write_errors = {}
+        affected = len(operations)
+        if operations:
+            try:
+                res = self.model.bulk_write(operations, ordered=False, write_concern=self.write_concern)
+                affected = res.deleted_count if self.real_delete else res.matched_count
+            except BulkWriteError as e:
+                write_errors = {error['index']: error for error in e.details['writeErrors']}
+                affected = e.details['nRemoved'] if self.real_delete else e.details['nMatched']
+
+        for i, result in enumerate(deleting):
+            error = write_errors.get(i)
+            if error:
+                result.update(errors=error['errmsg'], status=400)
+
+        succeeded = [result for result in deleting if 'errors' not in result]
+        if affected < len(succeeded):
+            # Some were deleted or left this user's scope since they were looked up. Those still found weren't
+            # deleted
+            try:
+                remaining = self._bulk_find_ids(request, [result['id'] for result in succeeded])
+            except ModelPermissionException:
+                remaining = {}
+            for result in succeeded:
+                if result['id'] in remaining:
+                    result.update(errors=self.model.msg404(result['id']), status=404)
+
+        deleted = [({'_id': model_ids[result['id']]}, ()) for result in deleting if 'errors' not in result]
+        self._create_audit_logs(request, deleted, audit.ACTIONS.DELETE, None)
+        return {'objects': results}
@@ -1,20 +1,37 @@
 from bson import ObjectId
 from bson.errors import InvalidId
 from collections import namedtuple
+from functools import wraps
+from django_mongo_rest import document_cache, identity_map, versions
 from mongoengine import Document, DateTimeField, BooleanField, StringField, DecimalField, ObjectIdField
 from mongoengine.errors import InvalidQueryError
 from mongoengine.queryset import Q
+from pymongo import DeleteOne, UpdateOne, WriteConcern
 from pymongo.errors import DuplicateKeyError
 
-FindParams = namedtuple('FindParams', 'projection sort limit request batch_size')
-FindParams.__new__.__defaults__ = (None, None, 0, None, 0)
+# read_preference is a pymongo ReadPreference. max_time_ms makes mongo give up on the query after that long.
+FindParams = namedtuple('FindParams', 'projection sort limit request batch_size read_preference max_time_ms')
+FindParams.__new__.__defaults__ = (None, None, 0, None, 0, None, None)
 
-UpdateParams = namedtuple('UpdateByIdParams', 'unset upsert request')
-UpdateParams.__new__.__defaults__ = ((), False, None)
+# write_concern is a pymongo WriteConcern, or a dict of its arguments such as {'w': 1}
+UpdateParams = namedtuple('UpdateByIdParams', 'unset upsert request write_concern')
+UpdateParams.__new__.__defaults__ = ((), False, None, None)
 
 class ModelPermissionException(Exception):
     pass
 
+def _write(func):
+    '''Forgets what was read from the collection before and after func writes to it, so that a read running
+    at the same time can't leave the old document in a cache'''
+    @wraps(func)
+    def wrapper(cls, *args, **kwargs):
+        cls._invalidate()
+        try:
+            return func(cls, *args, **kwargs)
+        finally:
+            cls._invalidate()
+    return wrapper
+
 class BaseModel(Document):
     meta = {'abstract': True}
 
@@ -64,16 +81,62 @@ class BaseModel(Document):
             }
         return query
 
+    @classmethod
+    def _read_collection(cls, params):
+        collection = cls._get_collection()
+        if params.read_preference is not None:
+            collection = collection.with_options(read_preference=params.read_preference)
+        return collection
+
+    @classmethod
+    def _write_collection(cls, write_concern):
+        collection = cls._get_collection()
+        if write_concern is not None:
+            if isinstance(write_concern, dict):
+                write_concern = WriteConcern(**write_concern)
+            collection = collection.with_options(write_concern=write_concern)
+        return collection
+
     @classmethod
     def find(cls, params=FindParams(), **kwargs):
         query = cls._get_lookup_query_find(kwargs, request=params.request)
-        return cls._get_collection().find(query, projection=params.projection, sort=params.sort,
-                                          limit=params.limit, batch_size=params.batch_size)
+        return cls._read_collection(params).find(query, projection=params.projection, sort=params.sort,
+                                                 limit=params.limit, batch_size=params.batch_size,
+                                                 max_time_ms=params.max_time_ms)
+
+    @classmethod
+    def _id_lookup(cls, kwargs):
+        '''Returns (True, id) when kwargs only looks up an id, otherwise (False, None)'''
+        if len(kwargs) != 1:
+            return False, None
+        query = cls._get_lookup_query(dict(kwargs), allow_deleted=True)
+        if '_id' not in query or isinstance(query['_id'], dict):
+            return False, None
+        return True, query['_id']
 
     @classmethod
     def find_one(cls, params=FindParams(), **kwargs):
+        id_map = identity_map.get_identity_map()
+        doc_cache = document_cache.get_cache(cls) if document_cache.cacheable(params) else None
+        is_id_lookup, doc_id = cls._id_lookup(kwargs) if id_map or doc_cache else (False, None)
+        if is_id_lookup and id_map:
+            found, doc = id_map.get(cls, doc_id, params)
+            if found:
+                return doc
+        if is_id_lookup and doc_cache:
+            found, doc = doc_cache.get_doc(doc_id, params.projection)
+            if found:
+                return doc
+            generation = doc_cache.generation()
+
         query = cls._get_lookup_query_find(kwargs, request=params.request)
-        return cls._get_collection().find_one(query, projection=params.projection)
+        doc = cls._read_collection(params).find_one(query, projection=params.projection,
+                                                    max_time_ms=params.max_time_ms)
+        if is_id_lookup and id_map:
+            id_map.set(cls, doc_id, params, doc)
+        if is_id_lookup and doc_cache:
+            doc_cache.set_doc(doc_id, params.projection, doc, generation)
+        return doc
 
     @classmethod
     def get_orm(cls, params=FindParams(), **kwargs):
@@ -88,15 +151,46 @@ class BaseModel(Document):
     def get_orm_by_id(cls, i, params=FindParams()):
         return cls.get_orm(params=params, _id=i)
 
+    @classmethod
+    def get_orm_by_ids(cls, ids, params=FindParams()):
+        if isinstance(cls.id, ObjectIdField):
+            ids = [ObjectId(i) for i in ids]
+        query = cls._get_lookup_query_find({'_id': {'$in': ids}}, request=params.request)
+        queryset = cls.objects.no_dereference().filter(__raw__=query)
+        if params.max_time_ms:
+            queryset = queryset.max_time_ms(params.max_time_ms)
+        return list(queryset)
+
     @classmethod
     def find_by_id(cls, i, params=FindParams()):
         return cls.find_one(_id=i, params=params)
 
     @classmethod
     def find_by_ids(cls, ids, params=FindParams()):
+        '''Returns a list, whether or not an identity map is active'''
         if isinstance(cls.id, ObjectIdField):
             ids = [ObjectId(i) for i in ids]
-        return cls.find(_id={'$in': ids}, params=params)
+
+        id_map = identity_map.get_identity_map()
+        if not id_map or params.sort or params.limit:
+            return list(cls.find(_id={'$in': ids}, params=params))
+
+        # Only query the ids that aren't mapped yet
+        docs = []
+        missing = []
+        for i in set(ids):
+            found, doc = id_map.get(cls, i, params)
+            if not found:
+                missing.append(i)
+            elif doc:
+                docs.append(doc)
+
+        if missing:
+            fetched = {doc['_id']: doc for doc in cls.find(_id={'$in': missing}, params=params)}
+            for i in missing:
+                id_map.set(cls, i, params, fetched.get(i))
+            docs.extend(fetched.values())
+        return docs
 
     @classmethod
     def find_by_ids_ordered(cls, ids, params=FindParams(), strict=True):
@@ -110,15 +204,32 @@ class BaseModel(Document):
         return docs
 
     @classmethod
-    def count(cls, request=None, **kwargs):
+    def count(cls, request=None, limit=0, params=FindParams(), **kwargs):
+        '''limit stops counting once that many documents matched (0 means count everything).
+        Only read_preference and max_time_ms of params are used.'''
         query = cls._get_lookup_query_find(kwargs, request=request)
-        return cls._get_collection().count(query)
+        options = {'maxTimeMS': params.max_time_ms} if params.max_time_ms else {}
+        return cls._read_collection(params).count(query, limit=limit, **options)
+
+    @classmethod
+    def estimated_count(cls, params=FindParams()):
+        '''Number of documents in the collection, read from collection metadata instead of scanning.
+        Includes deleted documents.'''
+        return cls._read_collection(params).count()
 
     @classmethod
     def exists(cls, request=None, **kwargs):
         params = FindParams(request=request, projection={'_id': 1})
         return bool(cls.find_one(params=params, **kwargs))
 
+    @classmethod
+    def _invalidate(cls):
+        '''Called around every write, to forget what was read from this collection'''
+        identity_map.invalidate(cls)
+        document_cache.invalidate(cls)
+        if versions.is_versioned(cls):
+            versions.bump(cls)
+
     @classmethod
     def _get_update_query(cls, unset=(), **kwargs):
         upd = {}
@@ -137,64 +248,96 @@ class BaseModel(Document):
         return upd
 
     @classmethod
+    @_write
     def update_one(cls, lookup_dict, update_params=UpdateParams(), **kwargs):
         query = cls._get_lookup_query_update(lookup_dict, request=update_params.request)
         upd = cls._get_update_query(unset=update_params.unset, **kwargs)
-        return cls._get_collection().update_one(query, upd, upsert=update_params.upsert)
+        return cls._write_collection(update_params.write_concern).update_one(query, upd,
+                                                                             upsert=update_params.upsert)
 
     @classmethod
+    @_write
     def replace_one(cls, lookup_dict, update_params=UpdateParams(), **kwargs):
         query = cls._get_lookup_query_update(lookup_dict, request=update_params.request)
-        return cls._get_collection().replace_one(query, kwargs, upsert=update_params.upsert)
+        return cls._write_collection(update_params.write_concern).replace_one(query, kwargs,
+                                                                              upsert=update_params.upsert)
 
     @classmethod
+    @_write
     def update_many(cls, lookup_dict, update_params=UpdateParams(), **kwargs):
         query = cls._get_lookup_query_update(lookup_dict, request=update_params.request)
         upd = cls._get_update_query(unset=update_params.unset, **kwargs)
-        return cls._get_collection().update_many(query, upd)
+        return cls._write_collection(update_params.write_concern).update_many(query, upd)
 
     @classmethod
     def update_by_id(cls, _id, update_params=UpdateParams(), **kwargs):
         return cls.update_one({'_id': _id}, update_params=update_params, **kwargs)
 
     @classmethod
+    @_write
     def find_one_and_update(cls, lookup_dict, update, update_params=UpdateParams(), return_document=True, projection=None):
         query = cls._get_lookup_query_update(lookup_dict, request=update_params.request)
         upd = cls._get_update_query(unset=update_params.unset, **update)
-        return cls._get_collection().find_one_and_update(query, upd, return_document=return_document,
-                                                         projection=projection, upsert=update_params.upsert)
+        collection = cls._write_collection(update_params.write_concern)
+        return collection.find_one_and_update(query, upd, return_document=return_document,
+                                              projection=projection, upsert=update_params.upsert)
+
+    @classmethod
+    def update_one_op(cls, lookup_dict, update_params=UpdateParams(), **kwargs):
+        '''Same as update_one, but returns the operation to send with bulk_write'''
+        query = cls._get_lookup_query_update(lookup_dict, request=update_params.request)
+        upd = cls._get_update_query(unset=update_params.unset, **kwargs)
+        return UpdateOne(query, upd, upsert=update_params.upsert)
+
+    @classmethod
+    def delete_one_op(cls, request=None, **kwargs):
+        '''Same as delete_one, but returns the operation to send with bulk_write'''
+        query = cls._get_lookup_query_update(kwargs, request=request)
+        return DeleteOne(query)
+
+    @classmethod
+    @_write
+    def bulk_write(cls, operations, ordered=False, write_concern=None):
+        return cls._write_collection(write_concern).bulk_write(operations, ordered=ordered)
 
     @classmethod
-    def delete_one(cls, request=None, **kwargs):
+    @_write
+    def delete_one(cls, request=None, write_concern=None, **kwargs):
         query = cls._get_lookup_query_update(kwargs, request=request)
-        return cls._get_collection().delete_one(query)
+        return cls._write_collection(write_concern).delete_one(query)
 
     @classmethod
-    def delete_by_id(cls, _id, request=None):
-        return cls.delete_one(request=request, _id=_id)
+    def delete_by_id(cls, _id, request=None, write_concern=None):
+        return cls.delete_one(request=request, write_concern=write_concern, _id=_id)
 
     @classmethod
-    def delete_many(cls, request=None, **kwargs):
+    @_write
+    def delete_many(cls, request=None, write_concern=None, **kwargs):
         query = cls._get_lookup_query_update(kwargs, request=request)
-        return cls._get_collection().delete_many(query)
+        return cls._write_collection(write_concern).delete_many(query)
 
     @classmethod
-    def insert_one(cls, doc):  # doc is not ** so insert_one can modify it
+    @_write
+    def insert_one(cls, doc, write_concern=None):  # doc is not ** so insert_one can modify it
         has_id = '_id' in doc
         try:
-            return cls._get_collection().insert_one(doc)
+            return cls._write_collection(write_concern).insert_one(doc)
         except DuplicateKeyError:
             if not has_id:
                 doc.pop('_id')  # Don't add an id if insert failed
             raise
 
     @classmethod
-    def insert_many(cls, objs, ordered=False):
-        return cls._get_collection().insert_many(objs, ordered=ordered)
+    @_write
+    def insert_many(cls, objs, ordered=False, write_concern=None):
+        return cls._write_collection(write_concern).insert_many(objs, ordered=ordered)
 
     @classmethod
-    def aggregate(cls, *args, **kwargs):
-        return cls._get_collection().aggregate(*args, **kwargs)
+    def aggregate(cls, pipeline, params=FindParams(), **kwargs):
+        '''Only read_preference and max_time_ms of params are used'''
+        if params.max_time_ms:
+            kwargs['maxTimeMS'] = params.max_time_ms
+        return cls._read_collection(params).aggregate(pipeline, **kwargs)
 
     @classmethod
     def get_collection_name(cls):
@@ -1,6 +1,10 @@
+from collections import namedtuple
+from bson import ObjectId
 from copy import deepcopy
-from django_mongo_rest.utils import to_list
-from mongoengine import EmbeddedDocumentField, ListField, ReferenceField, Document
+from django_mongo_rest.document_cache import get_dereference_cache
+from django_mongo_rest.models import FindParams
+from django_mongo_rest.utils import to_list, choices_maps
+from mongoengine import EmbeddedDocumentField, ListField, ReferenceField, Document, ObjectIdField
 from mongoengine.base.datastructures import BaseList
 
 def _document_typeof(doc_cls, field_name):
@@ -41,34 +45,118 @@ def _resolve_field(doc, field_name):
 
     raise AttributeError
 
-def _resolve_field_recursive(doc_cls, doc, field_segments, foreign_key_cache):
-    field = ''
-    for i, field in enumerate(field_segments):
-        doc = _resolve_field(doc, field)
+def _choices_display(field):
+    '''Maps db values to lowercase display values'''
+    maps = choices_maps(field)
+    return maps.to_display if maps else None
+
+# A plan is everything about serializing a document class that doesn't depend on the document itself.
+# It is built once per (document class, include_fields) and then reused for every document.
+_Plan = namedtuple('_Plan', 'fields_to_serialize fields foreign_keys has_preprocess')
+# How to serialize one of the serialize_fields. steps holds one _Step per dotted segment.
+# choices maps db values to display values for the resolved value.
+_FieldPlan = namedtuple('_FieldPlan', 'display steps choices value_cls')
+# doc_cls is the document type of the value found at this segment.
+# list_choices is used when the value is a list. list_unsupported means a list value here is skipped.
+_Step = namedtuple('_Step', 'name doc_cls foreign list_unsupported list_choices')
+# A foreign key that _prefetch_foreign_keys dereferences. sub_segments is what follows it, i.e. ['body']
+# for template.body
+_ForeignKeyPlan = namedtuple('_ForeignKeyPlan', 'field_name doc_cls sub_segments')
+
+_MAX_CACHED_PLANS = 10000
+_plans = {}
+
+def _build_step(prev_doc_cls, name):
+    doc_cls = _document_typeof(prev_doc_cls, name)
+    field_def = prev_doc_cls._fields.get(name) if prev_doc_cls else None
+    list_unsupported = prev_doc_cls is None or (field_def is not None and not hasattr(field_def, 'field'))
+    list_choices = None
+    if field_def is not None and not list_unsupported:
+        list_choices = _choices_display(field_def.field)
+    return _Step(name, doc_cls, bool(_is_foreign_key(doc_cls, name)), list_unsupported, list_choices)
+
+def _build_field_plan(doc_cls, field):
+    if isinstance(field, tuple):
+        field, display = field
+    else:
+        display = field
+
+    if display == '_id':
+        display = 'id'
+
+    # Recursively follow fields. i.e. template.body resolves to obj['template']['body']
+    steps = []
+    prev_doc_cls = None
+    for name in field.split('.'):
         prev_doc_cls = doc_cls
-        doc_cls = _document_typeof(doc_cls, field)
+        steps.append(_build_step(prev_doc_cls, name))
+        doc_cls = steps[-1].doc_cls
+
+    choices = None
+    if prev_doc_cls:
+        choices = _choices_display(prev_doc_cls._fields.get(steps[-1].name))
+
+    return _FieldPlan(display, tuple(steps), choices, doc_cls)
+
+def _build_plan(doc_cls, include_fields):
+    fields_to_serialize = tuple(_get_fields_to_serialize(doc_cls, include_fields=include_fields))
+
+    foreign_keys = []
+    for field_name in fields_to_serialize:
+        if isinstance(field_name, tuple):
+            field_name = field_name[0]
+
+        segments = field_name.split('.')
+        foreign_doc_cls = _document_typeof(doc_cls, segments[0])
+        if _is_foreign_key(foreign_doc_cls, segments[0]):
+            foreign_keys.append(_ForeignKeyPlan(segments[0], foreign_doc_cls, tuple(segments[1:])))
+
+    return _Plan(fields_to_serialize,
+                 tuple(_build_field_plan(doc_cls, field) for field in fields_to_serialize),
+                 tuple(foreign_keys),
+                 hasattr(doc_cls, 'serialize_preprocess'))
+
+def _get_plan(doc_cls, include_fields=None):
+    key = (doc_cls, frozenset(include_fields) if include_fields else None)
+    plan = _plans.get(key)
+    if plan is None:
+        plan = _build_plan(doc_cls, include_fields)
+        if len(_plans) < _MAX_CACHED_PLANS:
+            _plans[key] = plan
+    return plan
+
+def get_foreign_models(doc_cls, include_fields=None, _seen=None):
+    '''The document classes serialize dereferences foreign keys into, following foreign keys of those'''
+    seen = set() if _seen is None else _seen
+    for foreign_key in _get_plan(doc_cls, include_fields=include_fields).foreign_keys:
+        key = (foreign_key.doc_cls, foreign_key.sub_segments)
+        if key not in seen:
+            seen.add(key)
+            get_foreign_models(foreign_key.doc_cls, include_fields=foreign_key.sub_segments, _seen=seen)
+    return {foreign_doc_cls for foreign_doc_cls, _ in seen}
+
+def _resolve_planned_field(field_plan, doc, foreign_key_cache):
+    last = len(field_plan.steps) - 1
+    for i, step in enumerate(field_plan.steps):
+        doc = _resolve_field(doc, step.name)
 
         if isinstance(doc, (BaseList, list)):
-            if len(field_segments) > i + 1:
+            if i < last:
                 raise NotImplementedError('Serializing individual fields from ' +
                                           'embedded document list is unsupported')
-            field_def = prev_doc_cls._fields.get(field)
-            if field_def:
-                choices = getattr(field_def.field, 'choices', None)
-                if choices:
-                    choices_dict = dict(choices)
-                    doc = [choices_dict[v].lower() for v in doc]
-                return doc_cls, doc
+            if step.list_unsupported:
+                raise AttributeError
+            if step.list_choices:
+                doc = [step.list_choices[v] for v in doc]
+            return doc
 
-        elif _is_foreign_key(doc_cls, field):
-            doc = foreign_key_cache[doc_cls][doc]
+        elif step.foreign:
+            doc = foreign_key_cache[step.doc_cls][doc]
 
-    if prev_doc_cls:
-        choices = getattr(prev_doc_cls._fields.get(field), 'choices', None)
-        if choices:
-            doc = dict(choices)[doc].lower()
+    if field_plan.choices:
+        doc = field_plan.choices[doc]
 
-    return doc_cls, doc
+    return doc
 
 def _serialize_field(value_cls, value, request, foreign_key_cache):
     if value_cls and hasattr(value_cls, 'serialize_fields'):
@@ -89,30 +177,47 @@ def _get_fields_to_serialize(doc_cls, include_fields=None):
 
     return fields_to_serialize
 
-def _dereference(docs, field_name, document_type):
+def _dereference(docs, field_name, document_type, sub_field_segments):
+    '''sub_field_segments is what follows the foreign key. i.e. ['body'] for template.body'''
     ids = [doc[field_name] for doc in docs if field_name in doc]
-    return {foreign['_id']: foreign for foreign in document_type.find_by_ids(ids)}
-
-def _prefetch_foreign_keys(doc_cls, dicts, field_names):
+    if sub_field_segments:
+        projection = get_projection(document_type, include_fields=sub_field_segments,
+                                    extra_fields=['.'.join(sub_field_segments)])
+    else:
+        projection = get_projection(document_type)
+    params = FindParams(projection=projection)
+    doc_cache = get_dereference_cache(document_type)
+    if not doc_cache:
+        return {foreign['_id']: foreign for foreign in document_type.find_by_ids(ids, params=params)}
+
+    if isinstance(document_type.id, ObjectIdField):
+        ids = [ObjectId(i) for i in ids if i is not None]
+    foreign_docs, missing = doc_cache.get_docs(set(ids), projection)
+    if missing:
+        generation = doc_cache.generation()
+        fetched = {foreign['_id']: foreign for foreign in document_type.find_by_ids(missing, params=params)}
+        doc_cache.set_docs(missing, projection, fetched, generation)
+        foreign_docs.update(fetched)
+    return foreign_docs
+
+def _prefetch_foreign_keys(plan, dicts):
     '''If we're serializing a list and each member of that list has a foreign key
     that we need to dereference, we should make only one query to dereference them all.'''
     foreign_key_cache = {}
-    for field_name in field_names:
-        if isinstance(field_name, tuple):
-            field_name = field_name[0]
+    for foreign_key in plan.foreign_keys:
+        # Only fetch the fields of the foreign document that will actually be serialized
+        foreign_docs_by_id = _dereference(dicts, foreign_key.field_name, foreign_key.doc_cls,
+                                          list(foreign_key.sub_segments))
 
-        segments = field_name.split('.')
-        field_name = segments[0]
-        foreign_doc_cls = _document_typeof(doc_cls, field_name)
-        if _is_foreign_key(foreign_doc_cls, field_name):
-            foreign_docs_by_id = _dereference(dicts, field_name, foreign_doc_cls)
-            foreign_key_cache[foreign_doc_cls] = foreign_docs_by_id
-            foreign_doc_fields = _get_fields_to_serialize(foreign_doc_cls, include_fields=segments[1:])
-
-            sub_cache = _prefetch_foreign_keys(foreign_doc_cls, foreign_docs_by_id.itervalues(),
-                                               foreign_doc_fields)
-            for subdoc_cls, cache in sub_cache.items():
-                foreign_key_cache.setdefault(subdoc_cls, {}).update(cache)
+        # Several fields can reference the same collection, possibly with different projections
+        cached = foreign_key_cache.setdefault(foreign_key.doc_cls, {})
+        for foreign_id, foreign_doc in foreign_docs_by_id.iteritems():
+            cached.setdefault(foreign_id, foreign_doc).update(foreign_doc)
+
+        foreign_plan = _get_plan(foreign_key.doc_cls, include_fields=foreign_key.sub_segments)
+        sub_cache = _prefetch_foreign_keys(foreign_plan, foreign_docs_by_id.values())
+        for subdoc_cls, cache in sub_cache.items():
+            foreign_key_cache.setdefault(subdoc_cls, {}).update(cache)
 
     return foreign_key_cache
 
@@ -120,42 +225,98 @@ def _serialize(doc_cls, dicts, request, foreign_key_cache, include_fields=None):
     is_multiple = isinstance(dicts, (list, tuple))
     dicts = to_list(dicts)
 
-    fields_to_serialize = _get_fields_to_serialize(doc_cls, include_fields=include_fields)
+    plan = _get_plan(doc_cls, include_fields=include_fields)
 
     if foreign_key_cache is None:
-        foreign_key_cache = _prefetch_foreign_keys(doc_cls, dicts, fields_to_serialize)
+        foreign_key_cache = _prefetch_foreign_keys(plan, dicts)
 
-    if hasattr(doc_cls, 'serialize_preprocess'):
+    if plan.has_preprocess:
         dicts = deepcopy(dicts)
         doc_cls.serialize_preprocess(request, dicts)
 
     res = []
     for dct in dicts:
-
         fields = {}
-        for field in fields_to_serialize:
-            if isinstance(field, tuple):
-                field, display = field
-            else:
-                display = field
-
-            if display == '_id':
-                display = 'id'
-
-            # Recursively follow fields. i.e. template.body resolves to obj['template']['body']
-            segments = field.split('.')
-
+        for field_plan in plan.fields:
             try:
-                value_cls, value = _resolve_field_recursive(doc_cls, dct, segments, foreign_key_cache)
+                value = _resolve_planned_field(field_plan, dct, foreign_key_cache)
             except AttributeError:
                 continue
             else:
-                fields[display] = _serialize_field(value_cls, value, request, foreign_key_cache)
+                fields[field_plan.display] = _serialize_field(field_plan.value_cls, value, request,
+                                                              foreign_key_cache)
         res.append(fields)
 
     if is_multiple:
         return res
     return res[0]
 
+def _projection_paths(doc_cls, fields):
+    '''Mongo paths that serializing fields of doc_cls reads, or None if that can't be known'''
+    if hasattr(doc_cls, 'serialize_preprocess'):
+        # serialize_preprocess can read anything, so it has to declare what it reads
+        preprocess_fields = getattr(doc_cls, 'serialize_preprocess_fields', None)
+        if preprocess_fields is None:
+            return None
+        fields = tuple(fields) + tuple(preprocess_fields)
+
+    paths = []
+    for field in fields:
+        if isinstance(field, tuple):
+            field = field[0]
+
+        path = []
+        field_cls = doc_cls
+        for segment in field.split('.'):
+            path.append(segment)
+            if _is_dereference_disabled(segment) and segment not in getattr(field_cls, '_fields', {}):
+                # _resolve_field falls back to the field without the _id suffix
+                paths.append('.'.join(path[:-1] + [segment[:-len('_id')]]))
+                break
+
+            field_cls = _document_typeof(field_cls, segment)
+            if field_cls is None or issubclass(field_cls, Document):
+                # Plain value, or a foreign key which is dereferenced with a separate query
+                break
+        else:
+            # Embedded document (or list of them) serialized with its own serialize_fields
+            embedded_paths = _projection_paths(field_cls, getattr(field_cls, 'serialize_fields', ()))
+            if embedded_paths:
+                paths.extend('.'.join(path + [p]) for p in embedded_paths)
+                continue
+
+        paths.append('.'.join(path))
+
+    return paths
+
+def _remove_overlapping_paths(paths):
+    '''Mongo refuses to project both a.b and a'''
+    paths = set(paths)
+    return [path for path in paths
+            if not any('.'.join(path.split('.')[:i]) in paths for i in range(1, path.count('.') + 1))]
+
+_MAX_CACHED_PROJECTIONS = 10000
+_projections = {}
+
+def get_projection(doc_cls, include_fields=None, extra_paths=(), extra_fields=()):
+    '''Mongo projection that fetches only what serialize reads, or None when all fields are needed.
+
+    extra_paths are added to the projection as is. extra_fields are resolved like serialize_fields.
+    Models with serialize_preprocess must list the fields it reads in serialize_preprocess_fields,
+    otherwise they are never projected.'''
+    key = (doc_cls, tuple(include_fields or ()), tuple(extra_paths), tuple(extra_fields))
+    if key in _projections:
+        return _projections[key]
+
+    fields = tuple(_get_fields_to_serialize(doc_cls, include_fields=include_fields)) + tuple(extra_fields)
+    paths = _projection_paths(doc_cls, fields)
+    projection = None
+    if paths is not None:
+        paths = _remove_overlapping_paths(paths + list(extra_paths)) or ['_id']
+        projection = {path: 1 for path in paths}
+    if len(_projections) < _MAX_CACHED_PROJECTIONS:
+        _projections[key] = projection
+    return projection
+
 def serialize(doc_cls, dicts, request, include_fields=None):
     return _serialize(doc_cls, dicts, request, None, include_fields=include_fields)
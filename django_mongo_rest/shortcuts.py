@@ -2,9 +2,10 @@ from django.http.response import Http404
 from django_mongo_rest import ApiException
 from django_mongo_rest.models import FindParams, ModelPermissionException
 
-def get_object_or_404(model, request, kwargs):
+def get_object_or_404(model, request, kwargs, projection=None, max_time_ms=None):
     try:
-        obj = model.find_one(params=FindParams(request=request), **kwargs)
+        params = FindParams(request=request, projection=projection, max_time_ms=max_time_ms)
+        obj = model.find_one(params=params, **kwargs)
     except ModelPermissionException:
         raise ApiException(model.msg404(), 404)
 
@@ -1,6 +1,11 @@
-from bson import ObjectId
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from bson import BSON, ObjectId
+from bson.errors import BSONError
+from bson.json_util import dumps as bson_dumps
+from collections import namedtuple
 from datetime import datetime
 from enum import Enum as enum_Enum
+from hashlib import sha1
 
 def to_list(x):
     if isinstance(x, (list, tuple)):
@@ -22,11 +27,37 @@ def purge_empty_values(d, ignore=[]):
         return [v for v in (purge_empty_values(v) for v in d) if v]
     return {k: v for k, v in ((k, purge_empty_values(v)) for k, v in d.items()) if v or k in ignore}
 
+ChoicesMaps = namedtuple('ChoicesMaps', 'to_display from_display')
+
+def _build_choices_maps(choices):
+    '''choices is (value, display) pairs. Display values are lowercase in both maps'''
+    to_display = {value: display.lower() for value, display in choices}
+    return ChoicesMaps(to_display, {display: value for value, display in to_display.iteritems()})
+
+def choices_maps(field):
+    '''ChoicesMaps of a mongoengine field with (value, display) choices, or None. Built once per field'''
+    if field is None or isinstance(field, type):
+        # i.e. ListField(IntField), which has no choices
+        return None
+    try:
+        return field.__dict__['_dmr_choices_maps']
+    except KeyError:
+        pass
+
+    choices = getattr(field, 'choices', None)
+    maps = None
+    if choices and all(isinstance(c, (list, tuple)) for c in choices):
+        maps = _build_choices_maps(choices)
+    field._dmr_choices_maps = maps
+    return maps
+
 class EnumValueError(ValueError):
     def __init__(self, enum_cls):
-        msg = 'Must be one of %s' % str([k.lower() for k in enum_cls.reverse_dict.keys()])
+        msg = 'Must be one of %s' % str(enum_cls.choices_maps().from_display.keys())
         super(EnumValueError, self).__init__(msg)
 
+_enum_choices_maps = {}  # Enum class -> ChoicesMaps
+
 class Enum(enum_Enum):
     @classmethod
     def choices(cls):
@@ -36,20 +67,41 @@ class Enum(enum_Enum):
     def choices_dict(cls):
         return {choice.value: choice.name for choice in cls._member_map_.values()}
 
+    @classmethod
+    def choices_maps(cls):
+        maps = _enum_choices_maps.get(cls)
+        if maps is None:
+            maps = _enum_choices_maps[cls] = _build_choices_maps(cls.choices_dict().iteritems())
+        return maps
+
     @classmethod
     def to_display(cls, val):
-        return cls.choices_dict()[val].lower()
+        return cls.choices_maps().to_display[val]
 
     @classmethod
     def reverse(cls, val):
-        if not hasattr(cls, 'reverse_dict'):
-            cls.reverse_dict = {v.lower() : k for k, v in cls.choices_dict().iteritems()}
         try:
-            return cls.reverse_dict[val.lower()]
+            return cls.choices_maps().from_display[val.lower()]
         except KeyError:
             raise EnumValueError(cls)
 
 def json_default_serializer(obj):
     if isinstance(obj, (datetime, ObjectId)):
         return str(obj)
-    raise Exception('Can\'t serialize {} {}'.format(type(obj), obj))
\ No newline at end of file
+    raise Exception('Can\'t serialize {} {}'.format(type(obj), obj))
+
+def encode_cursor(sort, values):
+    '''Opaque, url safe token describing where the previous page of a keyset paginated list ended'''
+    return urlsafe_b64encode(BSON.encode({'s': sort, 'v': values})).rstrip('=')
+
+def decode_cursor(token):
+    '''Inverse of encode_cursor. Returns (sort, values). Raises ValueError for malformed tokens'''
+    try:
+        decoded = BSON(urlsafe_b64decode(str(token) + '=' * (-len(token) % 4))).decode()
+        return [tuple(s) for s in decoded['s']], decoded['v']
+    except (TypeError, ValueError, KeyError, BSONError):
+        raise ValueError('Invalid cursor')
+
+def query_hash(query):
+    '''Stable hash of a mongo query, so equivalent queries can share a cache key'''
+    return sha1(bson_dumps(query, sort_keys=True)).hexdigest()
@@ -0,0 +1,37 @@
+'''Collection version counters, kept in the django cache so that every process sees the same ones.
+
+A model with meta = {'versioned': True} has its version bumped by every write through BaseModel. Anything
+cached under a key that includes the versions it was built from, like ModelView responses with
+response_cache_seconds, is never read again once one of those collections is written to.'''
+import time
+from django.core.cache import cache
+
+def _key(model):
+    return 'dmr:version:%s' % model.get_collection_name()
+
+def is_versioned(model):
+    return bool(model._meta.get('versioned'))
+
+def _initial_version():
+    # When a counter is evicted it restarts from the current time, so it doesn't go back to a version that
+    # responses may still be cached under
+    return int(time.time() * 1000000)
+
+def get_versions(models):
+    '''{model: version}'''
+    keys = {_key(model): model for model in models}
+    versions = cache.get_many(keys.keys())
+    for key, model in keys.iteritems():
+        if key not in versions:
+            cache.add(key, _initial_version(), None)
+            versions[key] = cache.get(key)
+    return {model: versions[key] for key, model in keys.iteritems()}
+
+def bump(model):
+    key = _key(model)
+    try:
+        cache.incr(key)
+    except ValueError:
+        # Not set yet. Unless someone else just set it, then it still needs bumping
+        if not cache.add(key, _initial_version(), None):
+            cache.incr(key)
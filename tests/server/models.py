@@ -38,6 +38,7 @@ class User(AbstractUser, BaseModel):
 class PlaygroundEmbeddedDocAllOptional(EmbeddedDocument):
     serialize_fields = ('embedded_string',)
     embedded_string = StringField()
+    ref = ReferenceField('PlaygroundModel')
 
 class PlaygroundEmbeddedDoc(EmbeddedDocument):
     serialize_fields = ('embedded_string',)
@@ -68,3 +69,13 @@ class PlaygroundModel(BaseModel):
         return {'created_by': request.user.id}
 
     allowed_update_query = allowed_find_query
+
+class PlaygroundCachedModel(BaseModel):
+    meta = {
+        'cache': {'max_size': 2, 'ttl': 60},
+        'versioned': True,
+    }
+
+    serialize_fields = (('_id', 'id'), 'string')
+
+    string = StringField()
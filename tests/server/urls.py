@@ -1,4 +1,5 @@
 from django.conf.urls import url, include
+from django_mongo_rest.audit import AuditView
 from django_mongo_rest.shortcuts import url_optional_id
 import views
 
@@ -11,8 +12,17 @@ urlpatterns = [
         url(r'^params/$', views.Params().endpoint),
         url(r'^login_required/$', views.LoginRequired().endpoint),
         url(r'^superuser/$', views.Superuser().endpoint),
+        url(r'^audit/$', AuditView().endpoint),
         url(r'^model_get_only/%s$' % url_optional_id('obj_id'),
             views.PlaygroundModelViewGetOnly().endpoint),
+        url(r'^model_keyset/%s$' % url_optional_id('obj_id'),
+            views.PlaygroundModelViewKeyset().endpoint),
+        url(r'^model_facet/%s$' % url_optional_id('obj_id'),
+            views.PlaygroundModelViewFacet().endpoint),
+        url(r'^model_atomic/%s$' % url_optional_id('obj_id'),
+            views.PlaygroundModelViewAtomic().endpoint),
+        url(r'^model_cached/%s$' % url_optional_id('obj_id'),
+            views.PlaygroundCachedModelView().endpoint),
         url(r'^model/%s$' % url_optional_id('obj_id'),
             views.PlaygroundModelView().endpoint)
     ])),
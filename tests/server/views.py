@@ -3,7 +3,7 @@ from django.http.response import HttpResponse
 from django_mongo_rest import ApiView, PageView, PERMISSION
 from django_mongo_rest.validation import Param, email_validator
 from django_mongo_rest.model_view import ModelView
-from .models import PlaygroundModel
+from .models import PlaygroundModel, PlaygroundCachedModel
 
 class NoneApi(ApiView):
     permissions = []
@@ -81,16 +81,40 @@ class PlaygroundModelView(ModelView):
     permissions = [PERMISSION.LOGIN]
     editable_fields = {'string': 1, 'integer': 1, 'ref': 1, 'default_required': 1, 'default_optional': 1,
                        'embedded_list': ('embedded_string', 'start_date'), 'decimal': 1, 'boolean': 1,
-                       'embedded_list_optional': ('embedded_string',)}
+                       'embedded_list_optional': ('embedded_string', 'ref')}
     initial_fields = deepcopy(editable_fields)
     initial_fields['integer_immutable'] = 1
+    allow_bulk = True
+    idempotent_create = True
 
     @staticmethod
     def auto_populate_new_model(request, model):
         model['created_by'] = request.user.id
         model['integer_auto_populated'] = 8
 
+class PlaygroundModelViewAtomic(PlaygroundModelView):
+    allowed_methods = ['PATCH']
+    editable_fields = {'string': 1, 'decimal': 1, 'boolean': 1, 'embedded_list': ('embedded_string', 'start_date')}
+    atomic_update = True
+
 class PlaygroundModelViewGetOnly(PlaygroundModelView):
     allowed_methods = ['GET']
     permissions = []
     sortable_fields = ['id']
+    allow_streaming = True
+    stream_batch_size = 3
+    conditional_get = True
+
+class PlaygroundModelViewKeyset(PlaygroundModelViewGetOnly):
+    pagination = ModelView.PAGINATION_KEYSET
+    sortable_fields = ['id', 'integer']
+    count_cap = 3
+
+class PlaygroundModelViewFacet(PlaygroundModelViewGetOnly):
+    list_strategy = ModelView.LIST_FACET
+
+class PlaygroundCachedModelView(ModelView):
+    model = PlaygroundCachedModel
+    allowed_methods = ['GET']
+    permissions = PERMISSION.SUPERUSER
+    response_cache_seconds = 60
@@ -0,0 +1,141 @@
+import calendar
+import os
+import time
+from bson import ObjectId
+from datetime import datetime, timedelta
+from django.test import override_settings
+from django_mongo_rest import audit
+from django_mongo_rest.utils import encode_cursor
+from server.models import PlaygroundModel
+from server.settings import MONGODB
+from utils import DummyObject, assert_status, get_api
+
+def _request(user_id):
+    request = DummyObject()
+    request.user = DummyObject()
+    request.user.id = user_id
+    return request
+
+def test_async_sink():
+    sink = audit.AsyncSink(max_queue_size=3, batch_size=2, flush_interval=60)
+    request = _request(ObjectId())
+    doc_ids = [ObjectId() for _ in range(4)]
+    sink.write([audit._audit_doc(request, audit.ACTIONS.CREATE, PlaygroundModel, {'_id': doc_id}, {})
+                for doc_id in doc_ids])
+
+    # Doesn't wait for flush_interval
+    started = time.time()
+    sink.close()
+    assert time.time() - started < 5
+    stats = sink.stats()
+    assert stats['queued'] + stats['dropped'] == 4
+    assert stats['written'] == stats['queued']
+    assert stats['pending'] == 0
+    assert MONGODB.audit.count({'doc_id': {'$in': doc_ids}}) == stats['written']
+    MONGODB.audit.delete_many({'doc_id': {'$in': doc_ids}})
+
+def test_async_sink_after_fork():
+    sink = audit.AsyncSink(flush_interval=60)
+    doc_id = ObjectId()
+    sink.write([audit._audit_doc(_request(ObjectId()), audit.ACTIONS.CREATE, PlaygroundModel, {'_id': doc_id}, {})])
+
+    # A forked child doesn't write the parent's records again at exit
+    sink._pid = -1
+    sink._close_at_exit()
+    assert MONGODB.audit.count({'doc_id': doc_id}) == 0
+
+    sink._pid = os.getpid()
+    sink._close_at_exit()
+    assert MONGODB.audit.count({'doc_id': doc_id}) == 1
+    MONGODB.audit.delete_many({'doc_id': doc_id})
+
+def test_audit_view(superuser_session, user_session):
+    user, client = superuser_session
+    request = _request(user['_id'])
+    doc_id = ObjectId()
+    for i in range(5):
+        audit.create(request, audit.ACTIONS.UPDATE, PlaygroundModel, {'_id': doc_id}, {'integer': i})
+
+    url = 'audit/?model=playground_model&doc_id=%s&cnt=2' % doc_id
+    integers = []
+    res = get_api(url, client=client)
+    while True:
+        assert_status(res)
+        res = res.json()
+        assert all(obj['doc_id'] == str(doc_id) for obj in res['objects'])
+        integers.extend(obj['integer'] for obj in res['objects'])
+        if not res['next']:
+            break
+        res = get_api(url + '&after=' + res['next'], client=client)
+    assert integers == [4, 3, 2, 1, 0]
+
+    res = get_api('audit/?user=%s&cnt=1' % user['_id'], client=client)
+    assert_status(res)
+    assert res.json()['objects'][0]['integer'] == 4
+
+    assert_status(get_api('audit/?doc_id=%s' % doc_id, client=client), 400)
+    assert_status(get_api('audit/?model=playground_model&after=abc', client=client), 400)
+    for values in ([], 5, ['abc'], [{'$ne': None}]):
+        token = encode_cursor(audit.AuditView.SORT, values)
+        assert_status(get_api('audit/?model=playground_model&after=' + token, client=client), 400)
+    assert_status(get_api(url, client=user_session[1]), 404)
+
+    MONGODB.audit.delete_many({'doc_id': doc_id})
+
+@override_settings(DMR_AUDIT_SNAPSHOT_INTERVAL=2)
+def test_reconstruct(superuser_session):
+    user, client = superuser_session
+    request = _request(user['_id'])
+    doc_id = ObjectId()
+    start = datetime(2020, 1, 1)
+    changes = [
+        (audit.ACTIONS.CREATE, {'string': 'a', 'integer': 1}),
+        (audit.ACTIONS.UPDATE, {'string': 'b'}),
+        (audit.ACTIONS.UPDATE, {'integer': None}),
+        (audit.ACTIONS.UPDATE, {'string': 'c'}),
+        (audit.ACTIONS.UPDATE, {'integer': 5}),
+        (audit.ACTIONS.DELETE, {}),
+    ]
+    for i, (action, updates) in enumerate(changes):
+        record = audit._audit_doc(request, action, PlaygroundModel, {'_id': doc_id}, updates)
+        record['timestamp'] = start + timedelta(seconds=i)
+        record['_id'] = ObjectId.from_datetime(record['timestamp'])
+        audit.Audit.insert_one(record)
+
+    at = lambda seconds: start + timedelta(seconds=seconds)
+    assert audit.reconstruct(PlaygroundModel, doc_id, at(-1)) is None
+    assert audit.reconstruct(PlaygroundModel, doc_id, at(0.5)) == {'string': 'a', 'integer': 1}
+    assert audit.reconstruct('playground_model', doc_id, at(4)) == {'string': 'c', 'integer': 5}
+    assert audit.reconstruct(PlaygroundModel, doc_id, at(5)) is None
+    assert MONGODB.audit.count({'doc_id': doc_id, 'action': 'S'}) == 3
+
+    # Snapshots are used, and left out of the history
+    assert audit.reconstruct(PlaygroundModel, doc_id, at(2)) == {'string': 'b'}
+    res = get_api('audit/?model=playground_model&doc_id=%s&at=%d' % (doc_id, calendar.timegm(at(3).timetuple())),
+                  client=client)
+    assert_status(res)
+    assert res.json()['object'] == {'string': 'c'}
+    res = get_api('audit/?model=playground_model&doc_id=%s' % doc_id, client=client)
+    assert len(res.json()['objects']) == len(changes)
+
+    MONGODB.audit.delete_many({'doc_id': doc_id})
+
+@override_settings(DMR_AUDIT_SNAPSHOT_INTERVAL=1)
+def test_reconstruct_late_record(user):
+    request = _request(user['_id'])
+    doc_id = ObjectId()
+    audit.Audit.insert_one(audit._audit_doc(request, audit.ACTIONS.CREATE, PlaygroundModel, {'_id': doc_id},
+                                            {'string': 'a'}))
+    # Created before the next record, but written after it, like from an AsyncSink
+    late = audit._audit_doc(request, audit.ACTIONS.UPDATE, PlaygroundModel, {'_id': doc_id}, {'integer': 5})
+    audit.Audit.insert_one(audit._audit_doc(request, audit.ACTIONS.UPDATE, PlaygroundModel, {'_id': doc_id},
+                                            {'string': 'b'}))
+
+    at = datetime.utcnow() + timedelta(seconds=1)
+    assert audit.reconstruct(PlaygroundModel, doc_id, at) == {'string': 'b'}
+    # Recent records aren't snapshotted
+    assert MONGODB.audit.count({'doc_id': doc_id, 'action': 'S'}) == 0
+
+    audit.Audit.insert_one(late)
+    assert audit.reconstruct(PlaygroundModel, doc_id, at) == {'string': 'b', 'integer': 5}
+    MONGODB.audit.delete_many({'doc_id': doc_id})
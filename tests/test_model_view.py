@@ -1,14 +1,19 @@
 import calendar
 from copy import deepcopy
 from datetime import datetime, timedelta
+from hashlib import sha1
 from django.utils.timezone import now
 
+import json
 import pytest
 import pytz
 from bson import ObjectId
 from django_mongo_rest import serialize
-from server.models import PlaygroundModel
+from django_mongo_rest.model_view import ImproperlyConfigured, ModelView
+from django_mongo_rest.utils import encode_cursor
+from server.models import PlaygroundModel, PlaygroundCachedModel
 from server.settings import MONGODB
+from server.views import PlaygroundModelView, PlaygroundModelViewGetOnly
 from utils import (assert_status, patch_api, post_api, options_api, get_api, delete_api)
 
 
@@ -67,6 +72,61 @@ def test_get_by_id(model, user_session_const):
     clean_expected_model(model)
     assert model == res
 
+def test_get_by_id_sparse_fields(model, user_session_const):
+    _, client = user_session_const
+    res = get_api('model_get_only/%s/?fields=id,integer' % model['_id'], client=client)
+    assert res.json()['object'] == {'id': str(model['_id']), 'integer': model['integer']}
+
+    # Repeated and reordered fields are the same request
+    res = get_api('model_get_only/%s/?fields=integer,id,id,integer' % model['_id'], client=client)
+    assert res.json()['object'] == {'id': str(model['_id']), 'integer': model['integer']}
+
+    res = get_api('model_get_only/%s/?fields=id,created_by' % model['_id'], client=client)
+    assert_status(res, 400)
+
+def test_conditional_get(models, user_session_const):
+    _, client = user_session_const
+    url = 'model_get_only/%s/' % models[0]['_id']
+    res = get_api(url, client=client)
+    assert_status(res)
+    etag = res['ETag']
+    last_modified = res['Last-Modified']
+
+    assert_status(get_api(url, client=client, headers={'HTTP_IF_NONE_MATCH': etag}), 304)
+    assert_status(get_api(url, client=client, headers={'HTTP_IF_MODIFIED_SINCE': last_modified}), 304)
+    assert_status(get_api(url + '?fields=id', client=client, headers={'HTTP_IF_NONE_MATCH': etag}))
+
+    res = get_api('model_get_only/', client=client)
+    list_etag = res['ETag']
+    assert list_etag.startswith('W/')
+    assert_status(get_api('model_get_only/', client=client, headers={'HTTP_IF_NONE_MATCH': list_etag}), 304)
+
+    PlaygroundModel.update_by_id(models[0]['_id'], last_updated=now())
+    assert_status(get_api(url, client=client, headers={'HTTP_IF_NONE_MATCH': etag}))
+    assert_status(get_api(url, client=client, headers={'HTTP_IF_MODIFIED_SINCE': last_modified}))
+    assert_status(get_api('model_get_only/', client=client, headers={'HTTP_IF_NONE_MATCH': list_etag}))
+
+def test_response_cache(superuser_session_const):
+    _, client = superuser_session_const
+    PlaygroundCachedModel.insert_one({'string': 'cached'})
+    res = get_api('model_cached/', client=client).json()
+    assert [obj['string'] for obj in res['objects']] == ['cached']
+
+    # Not seen, since the response is cached
+    MONGODB.playground_cached_model.insert_one({'string': 'outside'})
+    assert get_api('model_cached/', client=client).json() == res
+    assert get_api('model_cached/?cnt=5', client=client).json()['num_matches'] == 2
+
+    # Writes through the model bump its version
+    PlaygroundCachedModel.update_many({}, string='after')
+    res = get_api('model_cached/', client=client).json()
+    assert [obj['string'] for obj in res['objects']] == ['after', 'after']
+    PlaygroundCachedModel.delete_many()
+
+    # PlaygroundModel isn't versioned
+    with pytest.raises(ImproperlyConfigured):
+        type('CachedView', (PlaygroundModelViewGetOnly,), {'response_cache_seconds': 60})()
+
 def test_get_by_id_logged_out(model):
     assert_status(get_api('model_get_only/%s/' % model['_id']), 404)
 
@@ -90,6 +150,104 @@ def test_pagination(models, user_session):
     assert returned_models[0] == expected_model
     assert 'num_matches' in res
 
+def test_keyset_pagination(models, user_session):
+    _, client = user_session
+    for i, model in enumerate(models):
+        model['integer'] = 50 - i
+        MONGODB.playground_model.update_one({'_id': model['_id']}, {'$set': {'integer': model['integer']}})
+
+    returned_ids = []
+    url = 'model_keyset/?cnt=3&sort=integer'
+    while True:
+        res = get_api(url, client=client)
+        assert_status(res)
+        res = res.json()
+        assert res['num_matches'] == len(models)
+        returned_ids.extend(ObjectId(obj['id']) for obj in res['objects'])
+        if not res['next']:
+            break
+        url = 'model_keyset/?cnt=3&sort=integer&after=%s' % res['next']
+
+    assert returned_ids == [m['_id'] for m in reversed(models)]
+
+def _keyset_ids(client, query):
+    '''Pages through model_keyset one object at a time'''
+    returned_ids = []
+    url = 'model_keyset/?cnt=1&%s' % query
+    while True:
+        res = get_api(url, client=client)
+        assert_status(res)
+        res = res.json()
+        returned_ids.extend(ObjectId(obj['id']) for obj in res['objects'])
+        if not res['next']:
+            return returned_ids
+        url = 'model_keyset/?cnt=1&%s&after=%s' % (query, res['next'])
+
+def test_keyset_pagination_missing_values(models, user_session):
+    _, client = user_session
+    MONGODB.playground_model.update_many({'_id': {'$in': [models[0]['_id'], models[1]['_id']]}},
+                                         {'$unset': {'integer': 1}})
+    MONGODB.playground_model.update_one({'_id': models[2]['_id']}, {'$set': {'integer': 5}})
+    MONGODB.playground_model.update_one({'_id': models[3]['_id']}, {'$set': {'integer': 3}})
+
+    # Missing values come first when ascending, last when descending
+    ids = [m['_id'] for m in models]
+    assert _keyset_ids(client, 'sort=integer') == [ids[0], ids[1], ids[3], ids[2]]
+    assert _keyset_ids(client, 'sort=integer&sortDir=-1') == [ids[2], ids[3], ids[1], ids[0]]
+
+def test_keyset_pagination_invalid_token(user_session_const):
+    _, client = user_session_const
+    assert_status(get_api('model_keyset/?after=garbage', client=client), 400)
+    # Operators in place of values would match documents the client didn't page through
+    token = encode_cursor([('integer', 1), ('_id', 1)], [{'$ne': None}, {'$ne': None}])
+    assert_status(get_api('model_keyset/?sort=integer&after=%s' % token, client=client), 400)
+    assert_status(get_api('model_keyset/?skip=3', client=client), 400)
+
+def test_count_modes(models, user_session):
+    _, client = user_session
+    res = get_api('model_keyset/?count=capped', client=client)
+    assert res.json()['num_matches'] == '3+'
+
+    res = get_api('model_get_only/?count=capped', client=client)
+    assert res.json()['num_matches'] == len(models)
+
+    res = get_api('model_get_only/?count=estimated', client=client)
+    assert res.json()['num_matches'] == len(models)
+
+    res = get_api('model_get_only/?count=off', client=client)
+    assert res.json()['num_matches'] is None
+    assert len(res.json()['objects']) == len(models)
+
+    assert_status(get_api('model_get_only/?count=sometimes', client=client), 400)
+
+def test_facet_pagination(models, user_session):
+    _, client = user_session
+
+    res = get_api('model_facet/?cnt=2&skip=1&sort=id&sortDir=-1', client=client)
+    assert_status(res)
+    res = res.json()
+    assert res['num_matches'] == len(models)
+    assert [ObjectId(obj['id']) for obj in res['objects']] == [models[2]['_id'], models[1]['_id']]
+
+    res = get_api('model_facet/?count=off', client=client).json()
+    assert res['num_matches'] is None
+    assert len(res['objects']) == len(models)
+
+def test_streaming(models, user_session):
+    _, client = user_session
+    expected_ids = [str(m['_id']) for m in models]
+
+    res = get_api('model_get_only/?format=ndjson&sort=id', client=client)
+    assert_status(res)
+    lines = ''.join(res.streaming_content).splitlines()
+    assert [json.loads(line)['id'] for line in lines] == expected_ids
+
+    res = get_api('model_get_only/?format=json_stream&sort=id&fields=id', client=client)
+    assert_status(res)
+    assert json.loads(''.join(res.streaming_content)) == [{'id': i} for i in expected_ids]
+
+    assert_status(get_api('model_get_only/?format=xml', client=client), 400)
+
 def test_delete_not_supported():
     assert_status(delete_api('model_get_only/'), 405)
 
@@ -201,7 +359,9 @@ def test_post_less_than_equal_to(user_session_const):
     assert_status(res, 400)
     assert res.json()['message'] == {'integer_immutable': 'Must be <= integer'}
 
-def _assert_models_equal(user, expected, actual):
+def _assert_models_equal(user, expected, actual, defaults=True):
+    '''defaults: whether actual was created with the field defaults, as opposed to being a fixture that lacks
+    them'''
     actual = deepcopy(actual)
     expected = deepcopy(expected)
 
@@ -210,8 +370,9 @@ def _assert_models_equal(user, expected, actual):
     assert datetime.utcnow().replace(tzinfo=pytz.utc) - actual.pop('last_updated') < timedelta(seconds=1)
     expected.pop('last_updated', None)
     expected.pop('not_editable', None)
-    expected.setdefault('default_required', 7)
-    expected.setdefault('default_optional', 20)
+    if defaults:
+        expected.setdefault('default_required', 7)
+        expected.setdefault('default_optional', 20)
 
     assert expected == actual
 
@@ -261,6 +422,48 @@ def test_create(user_session_const, model):
     del expected['boolean']  # We don't store false bools, waste of space
     _verify_created_model(user, client, expected)
 
+def test_create_idempotency_key(user_session_const):
+    _, client = user_session_const
+    headers = {'HTTP_IDEMPOTENCY_KEY': str(ObjectId())}
+    data = {'string': 'idempotent', 'integer': 5}
+
+    res = post_api('model/', client=client, data=data, headers=headers)
+    assert_status(res)
+    obj_id = res.json()['id']
+
+    # Replayed, not created again
+    res = post_api('model/', client=client, data=data, headers=headers)
+    assert_status(res)
+    assert res.json() == {'id': obj_id}
+    assert MONGODB.playground_model.count({'string': 'idempotent'}) == 1
+
+    res = post_api('model/', client=client, data={'string': 'different'}, headers=headers)
+    assert_status(res, 422, 'IDEMPOTENCY_MISMATCH')
+
+    MONGODB.playground_model.delete_one({'_id': ObjectId(obj_id)})
+
+def test_create_idempotency_key_expired_lease(user_session_const):
+    user, client = user_session_const
+    key = str(ObjectId())
+    body = json.dumps({'string': 'idempotent lease', 'integer': 5})
+    # Left behind by a request that died while creating
+    MONGODB.idempotency_key.insert_one({
+        'key': key, 'user': user['_id'], 'scope': 'playground_model', 'request_hash': sha1(body).hexdigest(),
+        'state': 'in_progress', 'lease': ObjectId(), 'lease_expires': datetime.utcnow() - timedelta(seconds=1),
+        'created': datetime.utcnow()})
+
+    # A different request with the same key is refused even while the key is held
+    res = post_api('model/', client=client, data={'string': 'different'}, headers={'HTTP_IDEMPOTENCY_KEY': key})
+    assert_status(res, 422, 'IDEMPOTENCY_MISMATCH')
+
+    res = post_api('model/', client=client, data=body, headers={'HTTP_IDEMPOTENCY_KEY': key})
+    assert_status(res)
+    obj_id = res.json()['id']
+    assert MONGODB.idempotency_key.find_one({'key': key})['state'] == 'done'
+
+    MONGODB.playground_model.delete_one({'_id': ObjectId(obj_id)})
+    MONGODB.idempotency_key.delete_one({'key': key})
+
 def test_create_other_user(user_session_const):
     '''We try setting created_by to someone else, but api should ignore us'''
     user, client = user_session_const
@@ -338,6 +541,26 @@ def test_embedded_doc_list_type_err(user_session_const):
                     'integer': 'sdfg could not be converted to int'}
     assert res.json()['message'] == expected_msg
 
+def test_embedded_doc_list_refs(user_session_const, models):
+    '''References in embedded lists are checked too, and errors point at the right item'''
+    _, client = user_session_const
+    missing = ObjectId()
+    data = {
+        'string': 'embref',
+        'ref': models[0]['_id'],
+        'embedded_list_optional': [{'ref': models[1]['_id']}, {'ref': missing}, {'ref': models[2]['_id']}]
+    }
+
+    res = post_api('model/', client=client, data=data)
+    assert_status(res, 400)
+    assert res.json()['message'] == {'embedded_list_optional': {'1': {
+        'ref': "playground_model %s does not exist or you don't have permissions on it" % missing}}}
+
+    data['embedded_list_optional'][1]['ref'] = models[3]['_id']
+    res = post_api('model/', client=client, data=data)
+    assert_status(res)
+    MONGODB.playground_model.delete_one({'_id': ObjectId(res.json()['id'])})
+
 def test_embedded_doc_list_extra_field(user_session_const):
     user, client = user_session_const
     expected = {
@@ -366,7 +589,7 @@ def _verify_update(user, client, model, expected_model=None):
     if 'boolean' in expected_model and expected_model['boolean'] is None:
         del expected_model['boolean']
 
-    _assert_models_equal(user, expected_model, db_model)
+    _assert_models_equal(user, expected_model, db_model, defaults=False)
 
     del model['decimal']
 
@@ -389,6 +612,43 @@ def test_update(user_session_const, model):
     del model['decimal']
     _assert_audit_log(model, user['_id'], 'U')
 
+def test_update_sets_changed_fields_only(user_session_const, model):
+    user, client = user_session_const
+    # Written by someone else after this client loaded the model
+    MONGODB.playground_model.update_one({'_id': model['_id']}, {'$set': {'embedded_list.0.embedded_string': 'x'}})
+
+    assert_status(patch_api('model/%s/' % model['_id'], client=client, data={'integer': 7}))
+
+    db_model = PlaygroundModel.find_by_id(model['_id'])
+    assert db_model['integer'] == 7
+    assert db_model['embedded_list'][0]['embedded_string'] == 'x'
+    assert db_model['last_updated'] > model['last_updated']
+    _assert_audit_log({'_id': model['_id'], 'integer': 7}, user['_id'], 'U')
+
+def test_update_doesnt_save_defaults(user_session_const, model):
+    _, client = user_session_const
+    # The fixture was stored without default_required and default_optional, like documents from before they
+    # existed
+    assert_status(patch_api('model/%s/' % model['_id'], client=client, data={'integer': 7}))
+
+    db_model = MONGODB.playground_model.find_one({'_id': model['_id']})
+    assert db_model['integer'] == 7
+    assert 'default_required' not in db_model
+    assert 'default_optional' not in db_model
+
+def test_update_post_process_nested_edit(user_session_const, model, monkeypatch):
+    _, client = user_session_const
+
+    def post_process_model(self, request, obj):
+        obj['embedded_list'][0]['embedded_string'] = 'processed'  # In place
+    monkeypatch.setattr(PlaygroundModelView, 'post_process_model', post_process_model)
+
+    assert_status(patch_api('model/%s/' % model['_id'], client=client, data={'integer': 7}))
+
+    db_model = MONGODB.playground_model.find_one({'_id': model['_id']})
+    assert db_model['integer'] == 7
+    assert db_model['embedded_list'][0]['embedded_string'] == 'processed'
+
 def test_update_true_bools_saved(user_session_const, model):
     user, client = user_session_const
     model['boolean'] = True
@@ -436,6 +696,42 @@ def test_update_out_of_date(user_session_const, model):
     expected['id'] = str(expected['id'])
     assert res['new_obj'] == expected
 
+def test_update_atomic(user_session_const, model):
+    user, client = user_session_const
+    last_updated = calendar.timegm(model['last_updated'].timetuple())
+
+    res = patch_api('model_atomic/%s/' % model['_id'], client=client,
+                    data={'string': 'atomic', 'last_updated': last_updated})
+    assert_status(res)
+    assert res.json()['object']['string'] == 'atomic'
+    assert res.json()['object']['integer'] == model['integer']
+    assert PlaygroundModel.find_by_id(model['_id'])['string'] == 'atomic'
+    _assert_audit_log({'_id': model['_id'], 'string': 'atomic'}, user['_id'], 'U')
+
+    # Stale last_updated
+    res = patch_api('model_atomic/%s/' % model['_id'], client=client,
+                    data={'string': 'stale', 'last_updated': last_updated})
+    assert_status(res, 409)
+    assert res.json()['new_obj']['string'] == 'atomic'
+
+    res = patch_api('model_atomic/%s/' % model['_id'], client=client, data={'string': 'x'})
+    assert_status(res, 400)
+
+    res = patch_api('model_atomic/%s/' % ObjectId(), client=client, data={'string': 'missing'})
+    assert_status(res, 404)
+
+def test_update_atomic_not_editable(user_session_const, model, monkeypatch):
+    _, client = user_session_const
+    # The user can still see the model, but no longer edit it
+    monkeypatch.setattr(PlaygroundModel, 'allowed_update_query', classmethod(lambda cls, request: {'created_by': None}))
+    last_updated = calendar.timegm(model['last_updated'].timetuple())
+
+    res = patch_api('model_atomic/%s/' % model['_id'], client=client,
+                    data={'string': 'atomic', 'last_updated': last_updated})
+    assert_status(res, 404)
+    assert 'new_obj' not in res.json()
+    assert PlaygroundModel.find_by_id(model['_id'])['string'] == model['string']
+
 def test_update_null_embedded_doc(user_session_const, model):
     '''Should not be saved'''
     user, client = user_session_const
@@ -471,4 +767,121 @@ def test_unset(user_session_const, model):
 
     del model['integer']
     del model['embedded_list']
-    _assert_models_equal(user, model, db_model)
+    _assert_models_equal(user, model, db_model, defaults=False)
+
+def test_bulk_create(user_session_const):
+    user, client = user_session_const
+    items = [
+        {'string': 'bulk1', 'integer': 5},
+        {'integer': 5},
+        {'string': 'bulk3', 'embedded_list': [{'embedded_string': '1'}]},
+    ]
+
+    res = post_api('model/', client=client, data=json.dumps(items))
+    assert_status(res)
+    results = res.json()['objects']
+    assert len(results) == 3
+    assert results[1] == {'errors': {'string': 'Field is required'}}
+
+    for i in (0, 2):
+        expected = deepcopy(items[i])
+        expected['_id'] = ObjectId(results[i]['id'])
+        _assert_audit_log(expected, user['_id'], 'C')
+
+        expected['integer_auto_populated'] = 8
+        _assert_models_equal(user, expected, PlaygroundModel.find_by_id(expected['_id']))
+
+def test_bulk_update(request, models, user_session):
+    user, client = user_session
+    other_users_model = _model(request)
+    other_users_model['created_by'] = ObjectId()
+    MONGODB.playground_model.insert_one(other_users_model)
+
+    items = [
+        {'id': str(models[0]['_id']), 'changes': {'integer': 6}},
+        {'id': str(models[1]['_id']), 'changes': {'integer': 'abc'}},
+        {'id': str(other_users_model['_id']), 'changes': {'integer': 7}},
+        {'id': str(models[2]['_id']), 'changes': {'string': 'changed'}},
+    ]
+    res = patch_api('model/', client=client, data=json.dumps(items))
+    assert_status(res)
+    results = res.json()['objects']
+
+    assert results[0] == {'id': items[0]['id']}
+    assert results[1]['status'] == 400
+    assert results[2]['status'] == 404
+    assert results[3] == {'id': items[3]['id']}
+
+    assert PlaygroundModel.find_by_id(models[0]['_id'])['integer'] == 6
+    assert PlaygroundModel.find_by_id(models[1]['_id'])['integer'] == models[1]['integer']
+    assert PlaygroundModel.find_by_id(other_users_model['_id'])['integer'] == other_users_model['integer']
+    assert PlaygroundModel.find_by_id(models[2]['_id'])['string'] == 'changed'
+    _assert_audit_log({'_id': models[0]['_id'], 'integer': 6}, user['_id'], 'U')
+
+    MONGODB.playground_model.delete_one({'_id': other_users_model['_id']})
+
+def test_bulk_update_lost_race(models, user_session, monkeypatch):
+    _, client = user_session
+    refuse = ModelView._refuse_conflicting_update
+
+    def refuse_then_race(self, input_data, request, existing_model):
+        refuse(self, input_data, request, existing_model)
+        if existing_model.id == models[0]['_id']:
+            # Between the lookup and the write, another user takes models[1] and edits models[2]
+            MONGODB.playground_model.update_one({'_id': models[1]['_id']}, {'$set': {'created_by': ObjectId()}})
+            MONGODB.playground_model.update_one({'_id': models[2]['_id']},
+                                                {'$set': {'string': 'theirs', 'last_updated': now()}})
+    monkeypatch.setattr(ModelView, '_refuse_conflicting_update', refuse_then_race)
+
+    last_updated = calendar.timegm(models[2]['last_updated'].timetuple())
+    items = [
+        {'id': str(models[0]['_id']), 'changes': {'integer': 6}},
+        {'id': str(models[1]['_id']), 'changes': {'integer': 6}},
+        {'id': str(models[2]['_id']), 'changes': {'integer': 6, 'last_updated': last_updated}},
+    ]
+    res = patch_api('model/', client=client, data=json.dumps(items))
+    assert_status(res)
+    results = res.json()['objects']
+    assert results[0] == {'id': items[0]['id']}
+    assert results[1]['status'] == 404
+    assert results[2]['status'] == 409
+    assert results[2]['new_obj']['string'] == 'theirs'
+
+    assert MONGODB.playground_model.find_one({'_id': models[1]['_id']})['integer'] == models[1]['integer']
+    assert MONGODB.playground_model.find_one({'_id': models[2]['_id']})['integer'] == models[2]['integer']
+    assert MONGODB.audit.count({'doc_id': {'$in': [models[1]['_id'], models[2]['_id']]}}) == 0
+
+def test_bulk_delete(models, user_session):
+    user, client = user_session
+    ids = [str(models[0]['_id']), str(ObjectId()), str(models[1]['_id'])]
+    res = delete_api('model/?ids=%s' % ','.join(ids), client=client)
+    assert_status(res)
+    results = res.json()['objects']
+    assert results[0] == {'id': ids[0]}
+    assert results[1]['status'] == 404
+    assert results[2] == {'id': ids[2]}
+
+    assert MONGODB.playground_model.count({'_id': {'$in': [models[0]['_id'], models[1]['_id']]},
+                                           'deleted': True}) == 2
+    _assert_audit_log({'_id': models[1]['_id']}, user['_id'], 'D')
+
+def test_bulk_delete_lost_race(models, user_session, monkeypatch):
+    user, client = user_session
+    find_ids = ModelView._bulk_find_ids
+
+    def bulk_find_ids(self, request, ids):
+        found = find_ids(self, request, ids)
+        # Another user takes models[1] between the lookup and the write
+        MONGODB.playground_model.update_one({'_id': models[1]['_id']}, {'$set': {'created_by': ObjectId()}})
+        return found
+    monkeypatch.setattr(ModelView, '_bulk_find_ids', bulk_find_ids)
+
+    ids = [str(models[0]['_id']), str(models[1]['_id'])]
+    res = delete_api('model/?ids=%s' % ','.join(ids), client=client)
+    assert_status(res)
+    results = res.json()['objects']
+    assert results[0] == {'id': ids[0]}
+    assert results[1]['status'] == 404
+
+    assert MONGODB.playground_model.find_one({'_id': models[1]['_id']}).get('deleted') is None
+    assert MONGODB.audit.count({'doc_id': models[1]['_id'], 'action': 'D'}) == 0
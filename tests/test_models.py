@@ -1,6 +1,13 @@
+import pytest
+from django.test import modify_settings
+from django_mongo_rest import document_cache, identity_map
+from django_mongo_rest.middleware import IdentityMapMiddleware
 from django_mongo_rest.models import FindParams
-from server.models import PlaygroundModel
-from utils import DummyObject
+from pymongo import ReadPreference
+from pymongo.errors import ExecutionTimeout
+from server.models import PlaygroundModel, PlaygroundCachedModel
+from server.settings import MONGODB
+from utils import DummyObject, assert_status, get_api
 
 def test_permission_queries(user):
     '''Model should add permission checks to the query'''
@@ -12,3 +19,68 @@ def test_permission_queries(user):
     request.user.is_superuser = False
     request.user.id = user['_id']
     assert PlaygroundModel.find_one(created_by='123', params=FindParams(request=request)) is None
+
+def test_identity_map():
+    PlaygroundModel.insert_one({'string': 'before'})
+    doc_id = PlaygroundModel.find_one(string='before')['_id']
+
+    with identity_map.activate():
+        assert PlaygroundModel.find_by_id(str(doc_id))['string'] == 'before'
+
+        # Not seen, since the document is read from the map
+        MONGODB.playground_model.update_one({'_id': doc_id}, {'$set': {'string': 'outside'}})
+        assert PlaygroundModel.find_by_id(doc_id)['string'] == 'before'
+        assert [doc['string'] for doc in PlaygroundModel.find_by_ids([doc_id])] == ['before']
+
+        # Writes through the model invalidate it
+        PlaygroundModel.update_by_id(doc_id, string='after')
+        assert PlaygroundModel.find_by_id(doc_id)['string'] == 'after'
+
+    MONGODB.playground_model.update_one({'_id': doc_id}, {'$set': {'string': 'outside'}})
+    assert PlaygroundModel.find_by_id(doc_id)['string'] == 'outside'
+    PlaygroundModel.delete_by_id(doc_id)
+
+@modify_settings(MIDDLEWARE={'append': 'django_mongo_rest.middleware.IdentityMapMiddleware'})
+def test_identity_map_middleware(superuser_session):
+    request = DummyObject()
+    IdentityMapMiddleware.process_request(request)
+    assert identity_map.get_identity_map() is not None
+    IdentityMapMiddleware.process_response(request, None)
+    assert identity_map.get_identity_map() is None
+
+    _, client = superuser_session
+    assert_status(get_api('model_get_only/', client=client))
+    assert identity_map.get_identity_map() is None
+
+def test_collection_options():
+    PlaygroundModel.insert_one({'string': 'options'}, write_concern={'w': 1})
+    params = FindParams(read_preference=ReadPreference.SECONDARY_PREFERRED, max_time_ms=1000)
+    assert [doc['string'] for doc in PlaygroundModel.find(params=params, string='options')] == ['options']
+    assert PlaygroundModel.count(params=params, string='options') == 1
+
+    with pytest.raises(ExecutionTimeout):
+        list(PlaygroundModel.find(params=FindParams(max_time_ms=1), **{'$where': 'sleep(100) || true'}))
+    PlaygroundModel.delete_many(string='options')
+
+def test_document_cache():
+    doc_ids = [PlaygroundCachedModel.insert_one({'string': str(i)}).inserted_id for i in range(3)]
+    doc_cache = document_cache.get_cache(PlaygroundCachedModel)
+    assert document_cache.get_cache(PlaygroundModel) is None
+
+    assert PlaygroundCachedModel.find_by_id(doc_ids[0])['string'] == '0'
+    MONGODB.playground_cached_model.update_one({'_id': doc_ids[0]}, {'$set': {'string': 'outside'}})
+    assert PlaygroundCachedModel.find_by_id(doc_ids[0])['string'] == '0'
+    assert PlaygroundCachedModel.find_by_id(doc_ids[0], params=FindParams(projection={'string': 1}))['string'] == \
+        'outside'
+    stats = doc_cache.stats()
+    assert (stats['hits'], stats['misses']) == (1, 2)
+
+    # Least recently used documents are evicted
+    PlaygroundCachedModel.find_by_id(doc_ids[1])
+    assert doc_cache.stats()['size'] == 2
+
+    # Writes through the model invalidate it
+    PlaygroundCachedModel.update_by_id(doc_ids[2], string='after')
+    assert doc_cache.stats()['size'] == 0
+    assert PlaygroundCachedModel.find_by_id(doc_ids[0])['string'] == 'outside'
+    PlaygroundCachedModel.delete_many()
@@ -1,14 +1,22 @@
+import json
 import random
 import time
 from copy import deepcopy
+from datetime import datetime
+from decimal import Decimal
 from itertools import chain
 
 import pytest
 from bson import ObjectId
-from django_mongo_rest import serialize
+from django_mongo_rest import encoders, serialize
+from django_mongo_rest.document_cache import get_dereference_cache
+from django_mongo_rest.models import FindParams
+from django_mongo_rest.serialize import get_projection
+from django_mongo_rest.utils import Enum, choices_maps
 from django_mongo_rest.models import BaseModel
 from mongoengine import (EmbeddedDocument, EmbeddedDocumentField, EmbeddedDocumentListField,
                          IntField, ListField, ReferenceField, StringField)
+from mongoengine.base.datastructures import BaseList
 from utils import uniquify
 
 
@@ -60,6 +68,21 @@ class SerializationDoc(BaseModel):
     foreign3 = ReferenceField(ForeignDoc3)
     val = IntField()
 
+class CachedForeignDoc(BaseModel):
+    meta = {
+        'dereference_cache': {'max_size': 100, 'ttl': 60},
+    }
+
+    serialize_fields = ('val',)
+
+    val = IntField()
+
+class CachedReferrerDoc(BaseModel):
+    serialize_fields = ('val', 'foreign')
+
+    val = IntField()
+    foreign = ReferenceField(CachedForeignDoc)
+
 def _embedded_doc():
     return {'val': random.random(), 'val2': random.random()}
 
@@ -157,3 +180,77 @@ def test_many(documents):
     '''Serialization should be fast
     Even though we have 2000 foreign keys, we should only make 2 queries (1 for each collecion)'''
     assert elapsed_time < 0.0003 * len(docs)
+
+def test_projection(documents):
+    docs, _, _, expected_serialized = documents
+    projection = get_projection(SerializationDoc)
+    assert projection == {
+        'val': 1,
+        'foreign': 1,
+        'foreign3': 1,
+        'foreign3_id': 1,
+        'embedded.val': 1,
+        'embedded.val2': 1,
+        'embedded_list.val': 1,
+        'with_choices': 1,
+        'with_choices_list': 1,
+        'int_list': 1,
+        'null_field': 1,
+    }
+
+    projected = SerializationDoc.find_by_ids_ordered([doc['_id'] for doc in docs[:10]],
+                                                     params=FindParams(projection=projection))
+    assert serialize(SerializationDoc, projected, None) == expected_serialized[:10]
+
+def test_dereference_cache():
+    foreign = [{'_id': ObjectId(), 'val': i} for i in range(3)]
+    CachedForeignDoc.insert_many(foreign)
+    docs = [{'val': i, 'foreign': foreign[i % 2]['_id']} for i in range(4)]
+    doc_cache = get_dereference_cache(CachedForeignDoc)
+
+    assert serialize(CachedReferrerDoc, docs, None) == [{'val': i, 'foreign': {'val': i % 2}} for i in range(4)]
+    assert doc_cache.stats()['misses'] == 2
+
+    # Only the id that isn't cached is fetched
+    CachedForeignDoc._get_collection().update_one({'_id': foreign[0]['_id']}, {'$set': {'val': 10}})
+    docs.append({'val': 4, 'foreign': foreign[2]['_id']})
+    res = serialize(CachedReferrerDoc, docs, None)
+    assert (res[0]['foreign'], res[4]['foreign']) == ({'val': 0}, {'val': 2})
+    stats = doc_cache.stats()
+    assert (stats['hits'], stats['misses']) == (2, 3)
+
+    # Writes through the model invalidate it
+    CachedForeignDoc.update_by_id(foreign[1]['_id'], val=11)
+    assert serialize(CachedReferrerDoc, docs[:2], None) == [{'val': 0, 'foreign': {'val': 10}},
+                                                            {'val': 1, 'foreign': {'val': 11}}]
+    CachedForeignDoc.delete_many()
+
+def test_choices_maps():
+    maps = choices_maps(SerializationDoc._fields['with_choices'])
+    assert maps.to_display == {'A': 'a_choice', 'B': 'b_choice'}
+    assert maps.from_display == {'a_choice': 'A', 'b_choice': 'B'}
+    assert choices_maps(SerializationDoc._fields['with_choices']) is maps
+    assert choices_maps(SerializationDoc._fields['int_list'].field) is None
+
+    class Color(Enum):
+        RED = 'r'
+        DARK_BLUE = 'b'
+
+    assert Color.to_display('b') == 'dark_blue'
+    assert Color.reverse('Dark_Blue') == 'b'
+    assert Color.choices_maps() is Color.choices_maps()
+    with pytest.raises(ValueError):
+        Color.reverse('green')
+
+def test_json_encoders():
+    oid = ObjectId()
+    when = datetime(2017, 1, 2, 3, 4, 5)
+    data = {'id': oid, 'when': [when], 'price': Decimal('0.10000000000000000001'), 'tags': BaseList(['a'], None, None)}
+    expected = {'id': str(oid), 'when': [str(when)], 'price': '0.10000000000000000001', 'tags': ['a']}
+
+    assert json.loads(encoders.get_dumps(encoders.JSON)(data)) == expected
+    with pytest.raises(Exception):
+        encoders.dumps({'unsupported': object()})
+
+    pytest.importorskip('simplejson')
+    assert json.loads(encoders.get_dumps(encoders.SIMPLEJSON)(data)) == expected
@@ -12,20 +12,20 @@ def json_default(obj):
         return str(obj)
     raise Exception('Can\'t serialize {} {}'.format(type(obj), obj))
 
-def _hit_api(method, url, data=None, client=None):
+def _hit_api(method, url, data=None, client=None, headers=None):
     client = client or Client()
-    return getattr(client, method)('/api/' + url, data=data, content_type='application/json')
+    return getattr(client, method)('/api/' + url, data=data, content_type='application/json', **(headers or {}))
 
-def post_api(url, data=None, client=None):
+def post_api(url, data=None, client=None, headers=None):
     if isinstance(data, dict):
         data = json.dumps(data, default=json_default)
-    return _hit_api('post', url, data=data, client=client)
+    return _hit_api('post', url, data=data, client=client, headers=headers)
 
 def delete_api(url, client=None):
     return _hit_api('delete', url, client=client)
 
-def get_api(url, client=None):
-    return _hit_api('get', url, client=client)
+def get_api(url, client=None, headers=None):
+    return _hit_api('get', url, client=client, headers=headers)
 
 def patch_api(url, data=None, client=None):
     if isinstance(data, dict):